@@ -0,0 +1,146 @@
+""" Apply filters to a batch of images without running the bot
+
+Usage:
+    python batch.py images/ avatar.png --filters blur,sepia+invert [--output output/] [--workers 4] [--format gif_global] [--effort 4]
+                    [--max-frame-bytes 1073741824] [--max-decoded-pixels 1000000000]
+
+Every input is rendered with every filter (or chain of filters joined with +) in parallel worker processes.
+The outputs are written to the output directory, along with manifest.json, which lists every output with its timing and peak memory.
+The size limits are much higher than the bot's by default, since the inputs here are trusted files rather than anything posted on Discord.
+Only utils/images (and Pillow) is imported, so this doubles as a way to profile the filters. """
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import UnidentifiedImageError
+
+from utils import images
+
+
+BATCH_MAX_FRAME_BYTES = 2 ** 30
+""" The default limit on how much memory a decoded frame can take up, enough for e.g. a 16000x16000 RGBA image """
+BATCH_MAX_DECODED_PIXELS = 1_000_000_000
+""" The default limit on how many pixels are decoded across the frames of an animated image """
+
+
+def find_inputs(paths: list[str]) -> list[str]:
+    """ Expand the directories among the paths into the files inside them (not recursively) """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            inputs.extend(sorted(entry.path for entry in os.scandir(path) if entry.is_file()))
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def output_names(inputs: list[str]) -> dict[str, str]:
+    """ Give each input a unique name to base its outputs' names on
+
+     The name keeps the input's extension (a.png -> a_png), so that a.png and a.jpg don't overwrite each other's outputs,
+     and a number is added if two inputs from different directories still end up with the same name. """
+    names, taken = {}, set()
+    for path in inputs:
+        if path in names:
+            continue
+        base = os.path.basename(path).replace(".", "_")
+        name, number = base, 1
+        while name in taken:
+            number += 1
+            name = f"{base}_{number}"
+        taken.add(name)
+        names[path] = name
+    return names
+
+
+def render_file(path: str, name: str, filter_names: list[str], output_dir: str, animated_format: str, effort: int, quality: int, threads: int,
+                max_frame_bytes: int, max_decoded_pixels: int) -> dict:
+    """ Render a single file with a single chain of filters - this runs inside a worker process """
+    chain = "+".join(filter_names)
+    result = {"input": path, "filter": chain}
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        output, file_format, peak_memory = images.render(data, filter_names, animated_format=animated_format, effort=effort, quality=quality,
+                                                          max_frame_bytes=max_frame_bytes, max_decoded_pixels=max_decoded_pixels, threads=threads)
+    except UnidentifiedImageError:
+        result["error"] = "Not a valid image"
+        return result
+    except (OSError, images.ImageRejected) as e:
+        result["error"] = str(e)
+        return result
+    output_path = os.path.join(output_dir, f"{name}_{"_".join(filter_names)}.{file_format}")
+    with open(output_path, "wb") as file:
+        file.write(output)
+    result.update({
+        "output": output_path,
+        "input_bytes": len(data),
+        "output_bytes": len(output),
+        "seconds": round(time.perf_counter() - start, 4),
+        "peak_memory_mb": round(peak_memory / 2 ** 20, 1),
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply filters to a batch of images without running the bot")
+    parser.add_argument("inputs", nargs="+", help="Images, or directories of images, to apply the filters to")
+    parser.add_argument("--filters", required=True, help="Comma-separated filters to apply, where each can be a chain like blur+invert")
+    parser.add_argument("--output", default="output", help="The directory to write the outputs and the manifest to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="How many worker processes to use (default: one per CPU core)")
+    parser.add_argument("--format", default="gif", choices=images.ANIMATED_FORMATS, help="The format to save animated images in")
+    parser.add_argument("--effort", type=int, default=images.DEFAULT_EFFORT, help="The encoding effort (0-6)")
+    parser.add_argument("--quality", type=int, default=images.DEFAULT_QUALITY, help="The quality (0-100) of WebP outputs")
+    parser.add_argument("--threads", type=int, default=0, help="How many threads each worker filters the frames of animated images in")
+    parser.add_argument("--max-frame-bytes", type=int, default=BATCH_MAX_FRAME_BYTES, help="Reject images whose frames would take up more than this many bytes once decoded")
+    parser.add_argument("--max-decoded-pixels", type=int, default=BATCH_MAX_DECODED_PIXELS, help="Cut animated images short after decoding this many pixels")
+    args = parser.parse_args()
+
+    try:
+        chains = [images.parse_chain(chain) for chain in args.filters.split(",")]
+    except images.InvalidFilter as e:
+        sys.exit(f"{e} - the available filters are: {", ".join(images.FILTERS)}")
+    inputs = find_inputs(args.inputs)
+    names = output_names(inputs)
+    os.makedirs(args.output, exist_ok=True)
+
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(render_file, path, names[path], filter_names, args.output, args.format, args.effort, args.quality, args.threads,
+                                   args.max_frame_bytes, args.max_decoded_pixels): (path, filter_names)
+                   for path in inputs for filter_names in chains}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:  # A broken file that Pillow fails on in some other way, or a worker that was killed (e.g. out of memory)
+                path, filter_names = futures[future]
+                result = {"input": path, "filter": "+".join(filter_names), "error": f"{type(e).__name__}: {e}"}
+            results.append(result)
+            if "error" in result:
+                print(f"{result["input"]} ({result["filter"]}): {result["error"]}")
+            else:
+                print(f"{result["input"]} ({result["filter"]}) -> {result["output"]}: {result["seconds"]:.3f}s, peak memory {result["peak_memory_mb"]:.1f} MiB")
+    results.sort(key=lambda result: (result["input"], result["filter"]))
+
+    manifest_path = os.path.join(args.output, "manifest.json")
+    with open(manifest_path, "w", encoding="utf-8") as file:
+        json.dump({
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "workers": args.workers,
+            "format": args.format,
+            "effort": args.effort,
+            "total_seconds": round(time.perf_counter() - start, 3),
+            "results": results,
+        }, file, indent=2)
+    failed = sum(1 for result in results if "error" in result)
+    print(f"Rendered {len(results) - failed} of {len(results)} images, see {manifest_path}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
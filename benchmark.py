@@ -0,0 +1,221 @@
+""" Benchmark every filter in utils/images on a synthetic set of images
+
+Usage:
+    python benchmark.py [--repeat 5] [--filters blur,sepia,save_to_bio:webp] [--samples small,gif_short] [--effort 4] [--threads 4] [--output benchmark.json]
+    python benchmark.py --compare old.json new.json [--threshold 10]
+
+Every (operation, sample) case runs in a fresh worker process, so the peak RSS reported for a case only includes that case.
+Nothing here touches the network or Discord, and only utils/images (and Pillow) is imported. """
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Callable
+
+from PIL import Image, ImageDraw
+
+from utils import general, images
+
+
+def _gradient(size: tuple[int, int], seed: int) -> Image.Image:
+    """ A deterministic, colourful RGB image that doesn't compress too well """
+    width, height = size
+    red = Image.linear_gradient("L").resize(size)
+    green = Image.radial_gradient("L").resize(size)
+    blue = Image.effect_mandelbrot(size, (-2 + seed * 0.01, -1.5, 1, 1.5), 64)
+    image = Image.merge("RGB", (red, green, blue))
+    draw = ImageDraw.Draw(image)
+    for i in range(24):
+        x = (i * 97 + seed * 13) % width
+        y = (i * 61 + seed * 7) % height
+        draw.ellipse((x, y, x + width // 6, y + height // 6), fill=((i * 37) % 256, (i * 91 + seed) % 256, (i * 53) % 256))
+    return image
+
+
+def _animated(size: tuple[int, int], frames: int) -> bytes:
+    """ An animated GIF with a moving shape on a transparent background """
+    width, height = size
+    output = []
+    for i in range(frames):
+        frame = Image.new("RGBA", size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(frame)
+        x = (i * 5) % width
+        draw.ellipse((x, height // 4, x + width // 3, height // 4 + height // 3), fill=(255, (i * 3) % 256, 40, 255))
+        draw.rectangle((0, height - height // 6, width, height), fill=(30, 180, (i * 7) % 256, 255))
+        output.append(frame)
+    bio = BytesIO()
+    output[0].save(bio, format="GIF", save_all=True, append_images=output[1:], duration=40, loop=0, disposal=2)
+    return bio.getvalue()
+
+
+def _encode(image: Image.Image, file_format: str, **params) -> bytes:
+    """ Encode the image into bytes """
+    bio = BytesIO()
+    image.save(bio, format=file_format, **params)
+    return bio.getvalue()
+
+
+def _rgba() -> bytes:
+    """ A PNG with a smooth alpha channel """
+    image = _gradient((512, 512), 3).convert("RGBA")
+    image.putalpha(Image.radial_gradient("L").resize((512, 512)))
+    return _encode(image, "PNG")
+
+
+SAMPLES: dict[str, Callable[[], bytes]] = {
+    "small": lambda: _encode(_gradient((256, 256), 1), "PNG"),
+    "large": lambda: _encode(_gradient((4000, 3000), 2), "JPEG", quality=90),  # Roughly a phone camera photo
+    "palette": lambda: _encode(_gradient((512, 512), 4).convert("P", palette=Image.Palette.ADAPTIVE), "PNG"),
+    "rgba": _rgba,
+    "gif_short": lambda: _animated((256, 256), 10),
+    "gif_long": lambda: _animated((320, 240), 300),
+}
+""" The synthetic images used by the benchmark, generated on demand """
+
+
+def _megapixels(data: bytes) -> tuple[float, bool]:
+    """ The total number of pixels in every frame of the image in millions, and whether the image is animated """
+    image = images.load_from_bytes(data)
+    n_frames = getattr(image, "n_frames", 1)
+    return image.width * image.height * n_frames / 1_000_000, n_frames > 1
+
+
+def _peak_rss() -> int:
+    """ Get the peak RSS of this process in bytes (0 if it can't be found out) """
+    usage = general.memory_usage(peak=True)
+    return usage[0] if usage is not None else 0
+
+
+def run_case(operation: str, data: bytes, repeat: int, effort: int, threads: int) -> dict:
+    """ Run a single operation on a single sample several times - this runs inside a fresh worker process
+
+     Filters are timed together with decoding the image, as that is part of their real cost.
+     save_to_bio is timed on its own, encoding the output of a cheap filter (flip).
+     "save_to_bio:webp" and the like encode animated images in the given format.
+     With threads set, the frames of animated images are filtered in that many threads. """
+    timings = []
+    output_bytes = 0
+    for _ in range(repeat):
+        if operation.startswith("save_to_bio"):
+            _, _, animated_format = operation.partition(":")
+            output = images.flip(images.load_from_bytes(data))
+            start = time.perf_counter()
+            output_bytes = len(images.save_to_bio(output, animated_format or "gif", effort=effort).getvalue())
+        else:
+            start = time.perf_counter()
+            image = images.load_from_bytes(data)
+            output = images.apply_chain(image, [operation], threads=threads) if threads else getattr(images, operation)(image)
+        timings.append(time.perf_counter() - start)
+    return {"timings": timings, "output_bytes": output_bytes, "peak_rss": _peak_rss()}
+
+
+def _idle() -> int:
+    """ Get the peak RSS of a worker process that did nothing but import the modules """
+    return _peak_rss()
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    """ Get a percentile of the values, interpolating between the closest two """
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(percentile) - 1]
+
+
+def run_benchmark(operations: list[str], samples: list[str], repeat: int, effort: int, threads: int) -> dict:
+    """ Run every operation on every sample and collect the results """
+    results = []
+    # A new process for every case, so that the peak RSS of one case doesn't carry over to the next one
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+        baseline_rss = executor.submit(_idle).result()
+        for sample in samples:
+            data = SAMPLES[sample]()
+            megapixels, animated = _megapixels(data)
+            for operation in operations:
+                if operation.startswith("save_to_bio:") and not animated:
+                    continue  # Still images are always saved as PNG
+                case = executor.submit(run_case, operation, data, repeat, effort, threads).result()
+                p50 = _percentile(case["timings"], 50)
+                p95 = _percentile(case["timings"], 95)
+                result = {
+                    "operation": operation,
+                    "sample": sample,
+                    "megapixels": round(megapixels, 3),
+                    "p50_ms": round(p50 * 1000, 2),
+                    "p95_ms": round(p95 * 1000, 2),
+                    "megapixels_per_second": round(megapixels / p50, 2),
+                    "peak_rss_mb": round(case["peak_rss"] / 2 ** 20, 1),
+                    "peak_rss_delta_mb": round((case["peak_rss"] - baseline_rss) / 2 ** 20, 1),
+                }
+                if case["output_bytes"]:
+                    result["output_bytes"] = case["output_bytes"]
+                results.append(result)
+                size = f", {result["output_bytes"]:,} bytes" if case["output_bytes"] else ""
+                print(f"{operation:>22} {sample:>10}: p50 {result["p50_ms"]:>9.2f} ms, p95 {result["p95_ms"]:>9.2f} ms, "
+                      f"{result["megapixels_per_second"]:>8.2f} MP/s, peak RSS {result["peak_rss_mb"]:>7.1f} MiB (+{result["peak_rss_delta_mb"]:.1f}){size}")
+    return {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "repeat": repeat,
+        "effort": effort,
+        "threads": threads,
+        "baseline_rss_mb": round(baseline_rss / 2 ** 20, 1),
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> bool:
+    """ Print the difference between two benchmark runs, returning whether any case got slower than the threshold (in %) """
+    old_results = {(result["operation"], result["sample"]): result for result in old["results"]}
+    regressed = False
+    for result in new["results"]:
+        previous = old_results.get((result["operation"], result["sample"]))
+        if previous is None:
+            continue
+        time_change = (result["p50_ms"] / previous["p50_ms"] - 1) * 100 if previous["p50_ms"] else 0
+        rss_change = result["peak_rss_delta_mb"] - previous["peak_rss_delta_mb"]
+        if time_change > threshold:
+            status = "REGRESSION"
+            regressed = True
+        elif time_change < -threshold:
+            status = "faster"
+        else:
+            status = ""
+        print(f"{result["operation"]:>22} {result["sample"]:>10}: p50 {previous["p50_ms"]:>9.2f} -> {result["p50_ms"]:>9.2f} ms "
+              f"({time_change:+6.1f}%), peak RSS {rss_change:+7.1f} MiB {status}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image filters without running the bot")
+    parser.add_argument("--repeat", type=int, default=5, help="How many times to run each case")
+    parser.add_argument("--filters", default="", help="Comma-separated operations to run (default: every filter and save_to_bio)")
+    parser.add_argument("--samples", default="", help="Comma-separated samples to run them on (default: all of them)")
+    parser.add_argument("--effort", type=int, default=images.DEFAULT_EFFORT, help="The encoding effort (0-6) used by save_to_bio")
+    parser.add_argument("--threads", type=int, default=0, help="How many threads to filter the frames of animated images in (default: one by one)")
+    parser.add_argument("--output", default="benchmark.json", help="Where to save the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two saved results instead of running the benchmark")
+    parser.add_argument("--threshold", type=float, default=10, help="How many % slower a case has to be to count as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        old_path, new_path = args.compare
+        with open(old_path, encoding="utf-8") as old_file, open(new_path, encoding="utf-8") as new_file:
+            regressed = compare(json.load(old_file), json.load(new_file), args.threshold)
+        sys.exit(1 if regressed else 0)
+
+    encoders = [f"save_to_bio:{animated_format}" for animated_format in images.ANIMATED_FORMATS]
+    operations = args.filters.split(",") if args.filters else [*images.FILTERS, "save_to_bio", *encoders]
+    samples = args.samples.split(",") if args.samples else list(SAMPLES)
+    results = run_benchmark(operations, samples, args.repeat, args.effort, args.threads)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+""" Run the bot as several processes, each with its own group of shards
+
+Usage:
+    python cluster.py [--clusters 4]
+
+The shards (all of them, or the ones listed in the sharding section of config.json) are split into groups of consecutive shards,
+and each group is run by a separate index.py process, so CPU-heavy work in one process doesn't slow down the others.
+The processes are started one after another, to stay within how many shards Discord lets the bot start at once.
+A process that crashes is restarted after restart_delay seconds (while the others keep being watched),
+while one that exits cleanly (e.g. the shutdown command) stays stopped. """
+import argparse
+import subprocess
+import sys
+import time
+
+from utils import general, sharding
+
+
+IDENTIFY_INTERVAL = 5
+""" How many seconds Discord wants between starting each shard (or each batch of max_concurrency shards) """
+
+
+def start_cluster(cluster: int, shard_ids: list[int], shard_count: int) -> subprocess.Popen:
+    """ Start an index.py process that runs the given shards """
+    print(f"{general.iso_time()} > Starting cluster {cluster} with shards {sharding.format_shards(shard_ids)}")
+    return subprocess.Popen([sys.executable, "index.py", "--cluster", str(cluster), "--shard-ids", ",".join(map(str, shard_ids)),
+                             "--shard-count", str(shard_count)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as several processes, each with its own group of shards")
+    parser.add_argument("--clusters", type=int, default=0, help="How many processes to run (default: the clusters value in config.json)")
+    args = parser.parse_args()
+
+    config = general.load_config()
+    options = config["sharding"]
+    try:
+        gateway = sharding.fetch_gateway(config["token"])
+    except sharding.GatewayError as e:
+        sys.exit(f"{general.iso_time()} > {e}")
+    shard_count = options["shard_count"] or gateway["shards"]
+    shard_ids = options["shard_ids"] or list(range(shard_count))
+    max_concurrency = gateway["session_start_limit"]["max_concurrency"]
+    groups = sharding.split_shards(shard_ids, args.clusters or options["clusters"])
+
+    processes: dict[int, subprocess.Popen] = {}
+    restarts: dict[int, float] = {}  # Crashed cluster -> when to start it again (time.monotonic)
+    try:
+        for cluster, group in enumerate(groups, start=1):
+            processes[cluster] = start_cluster(cluster, group, shard_count)
+            if cluster < len(groups):
+                time.sleep(IDENTIFY_INTERVAL * -(-len(group) // max_concurrency))  # Let this cluster's shards identify before starting the next one
+
+        while processes or restarts:
+            time.sleep(1)
+            for cluster, process in list(processes.items()):
+                if process.poll() is None:
+                    continue
+                del processes[cluster]
+                if process.returncode == 0:
+                    print(f"{general.iso_time()} > Cluster {cluster} has stopped")
+                else:
+                    general.print_stderr(f"{general.iso_time()} > Cluster {cluster} exited with code {process.returncode}, "
+                                         f"restarting it in {options["restart_delay"]}s")
+                    restarts[cluster] = time.monotonic() + options["restart_delay"]
+            for cluster, restart_time in list(restarts.items()):
+                if time.monotonic() >= restart_time:
+                    del restarts[cluster]
+                    processes[cluster] = start_cluster(cluster, groups[cluster - 1], shard_count)
+    except KeyboardInterrupt:
+        # The processes got the Ctrl+C too, so just give them time to shut down
+        for process in processes.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,6 @@
-import sys
-import time
-
 from discord.ext import commands
 
-from utils import bot_data, general
+from utils import bot_data, general, latency
 
 
 # These commands are for managing the bot, so they are owner-only text commands
@@ -22,8 +19,10 @@ class Admin(commands.Cog):
     @commands.command(name="reload")
     @commands.is_owner()
     async def reload_cog(self, ctx: commands.Context, cog_name: str):
-        """ Reload an extension """
-        await self.bot.reload_extension(f"cogs.{cog_name}")
+        """ Reload an extension, once the commands from it that are still running have finished """
+        still_running = await self.bot.lifecycle.reload_extension(f"cogs.{cog_name}", exclude=ctx)
+        if still_running:
+            return await ctx.send(f"Reloaded extension `cogs/{cog_name}.py`, but {still_running} of its commands were still running.")
         return await ctx.send(f"Successfully reloaded extension `cogs/{cog_name}.py`.")
 
     @commands.command(name="config")
@@ -33,15 +32,56 @@ class Admin(commands.Cog):
         self.bot.config = general.load_config()
         return await ctx.send(f"Successfully reloaded `config.json`.")
 
+    @commands.command(name="cache")
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context):
+        """ Show the render cache's and the download cache's statistics """
+        output = ["**Render cache**"]
+        output.extend(f"{key.replace("_", " ").capitalize()}: {value:,}" for key, value in self.bot.render_cache.stats().items())
+        output.append("**Download cache**")
+        output.extend(f"{key.replace("_", " ").capitalize()}: {value:,}" for key, value in self.bot.download_cache.stats().items())
+        return await ctx.send("\n".join(output))
+
+    @commands.command(name="metrics")
+    @commands.is_owner()
+    async def command_metrics(self, ctx: commands.Context):
+        """ Show how long each command takes (p50/p95 are bucket upper bounds) """
+        rows = self.bot.metrics.summary()
+        if not rows:
+            return await ctx.send("No commands have been used yet.")
+        output = [f"{"Command":<20} {"Calls":>6} {"Errors":>6} {"Mean":>7} {"p50":>6} {"p95":>6} {"Send p95":>8}"]
+        for command, calls, errors, mean, p50, p95, send_p95 in rows:
+            output.append(f"{command[:20]:<20} {calls:>6} {errors:>6} {mean:>6.2f}s {p50:>5g}s {p95:>5g}s {send_p95:>7g}s")
+        return await ctx.send(f"```\n{"\n".join(output)[:1950]}\n```")
+
+    @commands.command(name="latency")
+    @commands.is_owner()
+    async def latency_history(self, ctx: commands.Context):
+        """ Show the heartbeat and REST latency percentiles, and the worst spikes """
+        sampler = self.bot.latency_sampler
+        output = [f"{"Latency":<10} {"Samples":>7} {"Failed":>6} {"p50":>8} {"p95":>8} {"p99":>8} {"Max":>8}"]
+        for kind, values in sampler.summary().items():
+            output.append(f"{kind.capitalize():<10} {values["samples"]:>7} {values["failed"]:>6} {latency.milliseconds(values["p50"]):>8} "
+                          f"{latency.milliseconds(values["p95"]):>8} {latency.milliseconds(values["p99"]):>8} {latency.milliseconds(values["max"]):>8}")
+        spikes = [f"<t:{int(sample.time)}:R> - WS {latency.milliseconds(sample.heartbeat)}, REST {latency.milliseconds(sample.rest) if sample.rest is not None else "failed"}"
+                  for sample in sampler.spikes()]
+        return await ctx.send(f"```\n{"\n".join(output)}\n```**Worst spikes**\n{"\n".join(spikes) or "None yet"}")
+
+    @commands.command(name="queue")
+    @commands.is_owner()
+    async def queue_stats(self, ctx: commands.Context):
+        """ Show the image job queue's depth and wait times """
+        stats = self.bot.scheduler.stats()
+        return await ctx.send("\n".join(f"{key.replace("_", " ").capitalize()}: {f"{value:.2f}s" if isinstance(value, float) else f"{value:,}"}"
+                                        for key, value in stats.items()))
+
     @commands.command(name="shutdown")
     @commands.is_owner()
     async def shutdown(self, ctx: commands.Context):
-        """ Shut down the bot """
+        """ Shut down the bot, once the commands that are still running have finished """
         await ctx.send("Shutting down...")
-        print(f"{general.iso_time()} > {self.bot.name} > Shutting down...")
-        time.sleep(1)
-        sys.stderr.close()
-        sys.exit(0)
+        self.bot.logger.info("shutdown", "Shutting down...")
+        await self.bot.lifecycle.shutdown(exclude=ctx)
 
     @commands.command(name="sync")
     @commands.is_owner()
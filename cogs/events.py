@@ -11,14 +11,18 @@ class Events(commands.Cog):
     @commands.Cog.listener()
     async def on_command_completion(self, ctx: commands.Context):
         """ Triggered when a command successfully completes """
+        self.bot.metrics.record(ctx)
         guild = getattr(ctx.guild, "name", "Private Message") or "Private Server"
         content = ctx.message.clean_content if ctx.interaction is None else general.slash_command_string(ctx.interaction)
-        print(f"{general.iso_time()} > {self.bot.name} > {guild} > {ctx.author} ({ctx.author.id}) > {content}")
+        self.bot.logger.info("command", f"{guild} > {ctx.author} ({ctx.author.id}) > {content}",
+                             guild_id=getattr(ctx.guild, "id", None), shard_id=getattr(ctx.guild, "shard_id", None), user_id=ctx.author.id,
+                             command=ctx.command.qualified_name)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild: discord.Guild):
         """ Triggered when the bot joins a new guild """
-        print(f"{general.iso_time()} > {self.bot.name} > Joined {guild.name} ({guild.id})")
+        self.bot.guild_stats.recount(guild)
+        self.bot.logger.info("guild_join", f"Joined {guild.name} ({guild.id})", guild_id=guild.id, shard_id=guild.shard_id)
 
         if self.bot.config["join_message"]:
             # Find a text channel where we can send the "join message" and send it there
@@ -33,24 +37,49 @@ class Events(commands.Cog):
     @commands.Cog.listener()
     async def on_guild_remove(self, guild: discord.Guild):
         """ Triggered when the bot leaves a guild """
-        print(f"{general.iso_time()} > {self.bot.name} > Left {guild.name} ({guild.id})")
+        self.bot.guild_stats.remove_guild(guild.id)
+        self.bot.logger.info("guild_remove", f"Left {guild.name} ({guild.id})", guild_id=guild.id, shard_id=guild.shard_id)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         """ Triggered when a member joins a guild """
-        pass
+        self.bot.guild_stats.member_join(member)
 
     @commands.Cog.listener()
-    async def on_member_remove(self, member: discord.Member):
-        """ Triggered when a member leaves a guild """
-        pass
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        """ Triggered when a member leaves a guild, even if they weren't cached """
+        self.bot.guild_stats.member_remove(payload.guild_id, payload.user)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: discord.Guild):
+        """ Triggered when a guild becomes available, including when the bot starts up (after the guild's members are loaded) """
+        self.bot.guild_stats.recount(guild)
+
+    @commands.Cog.listener()
+    async def on_shard_ready(self, shard_id: int):
+        """ Triggered when one of the bot's shards has connected to Discord """
+        self.bot.logger.info("shard_ready", "Shard connected", shard_id=shard_id)
+
+    @commands.Cog.listener()
+    async def on_shard_disconnect(self, shard_id: int):
+        """ Triggered when one of the bot's shards loses its connection """
+        self.bot.logger.info("shard_disconnect", "Shard disconnected", shard_id=shard_id)
+
+    @commands.Cog.listener()
+    async def on_shard_resumed(self, shard_id: int):
+        """ Triggered when one of the bot's shards resumes its session after reconnecting """
+        self.bot.logger.info("shard_resumed", "Shard resumed", shard_id=shard_id)
 
     @commands.Cog.listener()
     async def on_ready(self):
         """ Triggered when the bot has connected to Discord """
         if self.bot.uptime is None:
             self.bot.uptime = general.now()
-        print(f"{general.iso_time()} > {self.bot.name} > Connected to Discord as {self.bot.user} - {len(self.bot.guilds)} guilds, {len(self.bot.users)} users")
+            self.bot.startup_report.ready(self.bot.logger, general.memory_usage(), guilds=len(self.bot.guilds), guilds_counted=len(self.bot.guild_stats.guilds),
+                                          chunk_at_startup=self.bot.config["member_cache"]["chunk_at_startup"], cluster=self.bot.cluster,
+                                          shards=sorted(self.bot.shards))
+        self.bot.logger.info("ready", f"Connected to Discord as {self.bot.user} - {len(self.bot.guilds)} guilds, {len(self.bot.users)} users",
+                             guilds=len(self.bot.guilds), users=len(self.bot.users))
 
 
 async def setup(bot: bot_data.Bot):
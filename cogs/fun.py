@@ -4,7 +4,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
-from utils import bot_data, emotes, general
+from utils import bot_data, emotes, general, snipes
 
 
 class Fun(commands.Cog):
@@ -12,7 +12,17 @@ class Fun(commands.Cog):
 
     def __init__(self, bot: bot_data.Bot):
         self.bot = bot
-        self.last_deleted_messages: dict[int, discord.Message] = {}
+        self.snipes: snipes.SnipeStore = snipes.SnipeStore.from_config(bot.config["snipe"])
+        self.snipe_database: snipes.SnipeDatabase | None = snipes.SnipeDatabase.from_config(bot.config["snipe"], bot.logger) if bot.config["snipe"]["database"] else None
+
+    async def cog_load(self):
+        if self.snipe_database is not None:
+            for channel_id, message in await self.snipe_database.open():
+                self.snipes.add(channel_id, message)
+
+    async def cog_unload(self):
+        if self.snipe_database is not None:
+            await self.snipe_database.close()
 
     @commands.hybrid_command(name="resign")
     @commands.cooldown(rate=1, per=2, type=commands.BucketType.user)
@@ -57,27 +67,28 @@ class Fun(commands.Cog):
     @commands.guild_only()
     @app_commands.allowed_installs(guilds=True, users=False)  # Cannot be used in user installs
     @app_commands.allowed_contexts(guilds=True, dms=False, private_channels=False)
-    async def snipe(self, ctx: commands.Context):
+    @app_commands.describe(number="Which deleted message to show, 1 being the most recent one")
+    async def snipe(self, ctx: commands.Context, number: commands.Range[int, 1, None] = 1):
         """ Catch the last deleted message in this channel """
-        message = self.last_deleted_messages.get(ctx.channel.id)
+        message = self.snipes.get(ctx.channel.id, number)
         if message is None:
-            return await ctx.send("There is nothing to snipe in this channel...", ephemeral=True)
+            if number == 1 or not (count := self.snipes.count(ctx.channel.id)):
+                return await ctx.send("There is nothing to snipe in this channel...", ephemeral=True)
+            return await ctx.send(f"There are only {count} deleted messages to snipe in this channel.", ephemeral=True)
         embed = discord.Embed(colour=general.random_colour())
-        if message.message_snapshots:
-            embed.title = "Forwarded Message Sniped"
-            snapshot = message.message_snapshots[0]
-            embed.description = snapshot.content
-        else:
-            embed.title = "Message Sniped"
-            embed.description = message.system_content
-        embed.set_author(name=message.author.global_name, icon_url=message.author.display_avatar)
+        embed.title = "Forwarded Message Sniped" if message.forwarded else "Message Sniped"
+        embed.description = message.content
+        embed.set_author(name=message.author_name, icon_url=message.avatar_url)
         embed.timestamp = message.created_at
         return await ctx.send(embed=embed, ephemeral=False)
 
     @commands.Cog.listener()
     async def on_message_delete(self, message: discord.Message):
         """ Triggered when a message is deleted """
-        self.last_deleted_messages[message.channel.id] = message
+        sniped = snipes.SnipedMessage.from_message(message)
+        self.snipes.add(message.channel.id, sniped)
+        if self.snipe_database is not None:
+            self.snipe_database.write(message.channel.id, sniped)
 
 
 async def setup(bot: bot_data.Bot):
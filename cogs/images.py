@@ -1,14 +1,18 @@
-import random
+import functools
+import hashlib
+import math
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
 from io import BytesIO
 
 import discord
-from PIL import Image, UnidentifiedImageError
 from discord import app_commands
 from discord.ext import commands
 
-from utils import bot_data, images, general
+from utils import bot_data, downloads, general, scheduler, workers
 
 
+images = general.lazy_import("utils.images")  # Pillow is only loaded once an image command is used
 FILTERS: list[str] = ["blur", "deepfry", "flip", "grayscale", "invert", "jpegify", "mirror", "pixelate", "rank", "sepia", "spread", "wide"]
 FILTER_CHOICES: list[app_commands.Choice[str]] = [
     # app_commands.Choice(name="List available filters", value="list"),
@@ -28,6 +32,20 @@ FILTER_CHOICES: list[app_commands.Choice[str]] = [
 ]
 
 
+@functools.cache
+def avatar_size() -> int:
+    """ The smallest avatar size that the CDN offers (a power of 2) which still has at least as many pixels as the filters use """
+    return 1 << math.isqrt(images.MAX_SIZE - 1).bit_length()
+
+
+async def filter_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    """ Suggest filters for the last filter in the chain """
+    *previous, last = current.lower().split("+")
+    prefix = "".join(f"{filter_name.strip()}+" for filter_name in previous)
+    return [app_commands.Choice(name=prefix + choice.name if prefix else choice.name, value=prefix + choice.value)
+            for choice in FILTER_CHOICES if choice.value.startswith(last.strip())][:25]
+
+
 class Images(commands.Cog):
     """ Commands about image manipulation """
 
@@ -67,28 +85,92 @@ class Images(commands.Cog):
         embed.add_field(name="Brightness", value=f"{brightness:.4f}", inline=False)
         embed.add_field(name="Text Colour", value="#000000" if brightness >= 128 else "#ffffff", inline=False)
 
-        image = Image.new(mode="RGBA", size=(512, 512), color=rgb_255)
-        bio = images.save_to_bio(image)
         embed.set_image(url="attachment://colour.png")
-        return await ctx.send(embed=embed, file=discord.File(bio, "colour.png"))
-
-    @staticmethod
-    async def _filter_command(ctx: commands.Context, asset: discord.Asset | discord.Attachment, filter_name: str):
+        return await ctx.send(embed=embed, file=discord.File(BytesIO(images.colour_swatch(int_6)), "colour.png"))
+
+    async def _download(self, asset: discord.Asset | discord.Attachment) -> bytes:
+        """ Download the image, without ever buffering more than the download limit
+
+         Assets are kept in the download cache under their key, attachments are downloaded every time. """
+        max_bytes = self.bot.config["images"]["max_download_bytes"]
+        if isinstance(asset, discord.Asset):
+            return await self.bot.download_cache.read(self.bot.session, asset.key, asset.url, max_bytes)
+        if asset.size > max_bytes:  # Attachments say how large they are upfront
+            raise downloads.DownloadTooLarge(f"The attachment is {asset.size:,} bytes large", max_bytes)
+        return await downloads.read(self.bot.session, asset.url, max_bytes)
+
+    @asynccontextmanager
+    async def _job_slot(self, ctx: commands.Context) -> AsyncGenerator[None, None]:
+        """ Wait for a free slot in the job scheduler, letting the user know straight away if they have to wait in line """
+        ticket = self.bot.scheduler.submit(ctx.author.id, ctx.guild.id if ctx.guild else None)
+        try:
+            if position := ticket.position:
+                await ctx.send(f"The bot is busy at the moment - you are number {position} in the queue.")
+            await ticket.wait()
+            yield
+        finally:
+            self.bot.scheduler.release(ticket)
+
+    async def _render(self, ctx: commands.Context, asset: discord.Asset | discord.Attachment, filter_names: list[str]) -> tuple[bytes, str]:
+        """ Get the filtered image from the render cache, or render it if it's not cached yet """
+        render_cache = self.bot.render_cache
+        options = self.bot.config["images"]
+        if isinstance(asset, discord.Asset):
+            data = None
+            source = f"asset:{asset.key}"  # Asset keys are already hashes of the image, so there's no need to download it first
+        else:
+            data = await self._download(asset)
+            source = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        chain = "+".join(filter_names)
+        deterministic = not any(filter_name in images.NON_DETERMINISTIC for filter_name in filter_names)
+        # Every setting that changes the output is part of the key, since the disk cache outlives config changes and updates
+        settings = (f"{options["animated_format"]}:{options["streaming"]}:{options["effort"]}:{options["quality"]}:"
+                    f"{options["max_frame_bytes"]}:{options["max_decoded_pixels"]}:v{images.PIPELINE_VERSION}")
+        key = render_cache.make_key(source, f"{chain}:{settings}", deterministic=deterministic)
+        if key is not None:
+            cached = await render_cache.get(key)
+            if cached is not None:
+                return cached
+        # Cached images are sent straight away, only the actual rendering has to wait for its turn
+        async with self._job_slot(ctx):
+            if data is None:
+                data = await self._download(asset)
+            # Decoding, filtering and encoding all happen in a worker process, so the bot stays responsive in the meantime
+            output, file_format, peak_memory = await self.bot.image_pool.run(images.render, data, filter_names, streaming=options["streaming"],
+                                                                             animated_format=options["animated_format"], effort=options["effort"],
+                                                                             quality=options["quality"], max_frame_bytes=options["max_frame_bytes"],
+                                                                             max_decoded_pixels=options["max_decoded_pixels"],
+                                                                             threads=options["frame_threads"])
+        pipeline = "streaming" if options["streaming"] else "buffered"
+        self.bot.logger.info("render", f"Rendered {chain} ({pipeline}): {len(output):,} bytes, peak memory {peak_memory / 2 ** 20:.1f} MiB",
+                             filters=chain, pipeline=pipeline, bytes=len(output), peak_memory=peak_memory, shard_id=getattr(ctx.guild, "shard_id", None))
+        if key is not None:
+            await render_cache.put(key, output, file_format)
+        return output, file_format
+
+    async def _filter_command(self, ctx: commands.Context, asset: discord.Asset | discord.Attachment, filter_name: str):
         """ Wrapper for the two filter subcommands """
-        filter_name = filter_name.lower()
-        if filter_name == "random":
-            filter_name = random.choice(FILTERS)
+        try:
+            # Random filters are picked here, before the cache lookup, so the output is cached under the actual filter
+            filter_names = images.parse_chain(filter_name)
+        except images.InvalidFilter as e:
+            return await ctx.send(f"{e} - use `filter list` to see the available filters, and join several filters with `+`.", ephemeral=True)
         async with ctx.typing(ephemeral=False):  # Defers the interaction
-            bio = BytesIO()
-            await asset.save(bio)
             try:
-                image = Image.open(bio)
-            except UnidentifiedImageError:
+                output, file_format = await self._render(ctx, asset, filter_names)
+            except scheduler.QueueFull as e:
+                return await ctx.send(str(e))
+            except images.UnidentifiedImageError:
                 return await ctx.send("The provided image does not seem to be valid...")
-        output: Image | list[Image] = getattr(images, filter_name)(image)
-        output_bio = images.save_to_bio(output)
-        file_format = "gif" if isinstance(output, list) else "png"
-        return await ctx.send(file=discord.File(output_bio, filename=f"{filter_name}.{file_format}"))
+            except downloads.DownloadTooLarge as e:
+                return await ctx.send(f"The provided image is too large - the limit is {e.limit / 2 ** 20:g} MiB.")
+            except images.ImageRejected as e:
+                return await ctx.send(f"{e}...")
+            except workers.JobTimeout as e:
+                return await ctx.send(f"Applying the filter took longer than {e.timeout:g} seconds, so it was cancelled...")
+            except workers.WorkerCrashed:
+                return await ctx.send("Applying the filter used up too many resources, so it was stopped...")
+        return await ctx.send(file=discord.File(BytesIO(output), filename=f"{"_".join(filter_names)}.{file_format}"))
 
     @commands.hybrid_group(name="filter", case_insensitive=True)
     @commands.cooldown(rate=1, per=5, type=commands.BucketType.user)
@@ -102,20 +184,24 @@ class Images(commands.Cog):
     @filter.command(name="list")
     async def filter_list(self, ctx: commands.Context):
         """ List available filters """
-        return await ctx.send(f"The following filters are currently available:\n`{"`, `".join(FILTERS)}`", ephemeral=True)
+        return await ctx.send(f"The following filters are currently available:\n`{"`, `".join(FILTERS)}`\n"
+                              f"You can also apply several filters at once by joining them with `+`, for example `blur+invert+wide`.", ephemeral=True)
 
     @filter.command(name="user")
-    @app_commands.describe(user="The user whose avatar to apply the filter on", filter_name="The name of the filter to apply")
-    @app_commands.choices(filter_name=FILTER_CHOICES)
+    @app_commands.describe(user="The user whose avatar to apply the filter on", filter_name="The name of the filter to apply (join several with +)")
+    @app_commands.autocomplete(filter_name=filter_autocomplete)
     async def filter_user(self, ctx: commands.Context, user: discord.User = None, filter_name: str = "random"):
         """ Apply a filter to a user's avatar """
         if user is None:
             user = ctx.author
-        return await self._filter_command(ctx, user.avatar, filter_name)
+        # display_avatar falls back to the default avatar for users who don't have one
+        # Animated avatars are requested as GIFs so that the filters can keep the animation, still ones as lossless PNGs
+        avatar = user.display_avatar.replace(size=avatar_size(), format="gif" if user.display_avatar.is_animated() else "png")
+        return await self._filter_command(ctx, avatar, filter_name)
 
     @filter.command(name="image")
-    @app_commands.describe(image="The image to apply the filter on", filter_name="The name of the filter to apply")
-    @app_commands.choices(filter_name=FILTER_CHOICES)
+    @app_commands.describe(image="The image to apply the filter on", filter_name="The name of the filter to apply (join several with +)")
+    @app_commands.autocomplete(filter_name=filter_autocomplete)
     async def filter_image(self, ctx: commands.Context, image: discord.Attachment, filter_name: str = "random"):
         """ Apply a filter to a provided image """
         return await self._filter_command(ctx, image, filter_name)
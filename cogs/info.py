@@ -1,10 +1,11 @@
 import time
+from collections import Counter
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from utils import bot_data, general
+from utils import bot_data, general, latency
 
 
 class Information(commands.Cog):
@@ -27,12 +28,25 @@ class Information(commands.Cog):
         embed.title = f"Stats about {self.bot.name} | v{version}"
         embed.set_thumbnail(url=str(self.bot.user.display_avatar.replace(size=1024, static_format="png")))
 
-        embed.add_field(name="Developer", value="\n".join(self.bot.get_user(uid).global_name for uid in self.bot.config["owners"]), inline=True)
+        developers = [await self.bot.member_lookup.get_user(uid) for uid in self.bot.config["owners"]]
+        embed.add_field(name="Developer", value="\n".join(user.global_name or user.name for user in developers if user is not None), inline=True)
         uptime = general.now() - self.bot.uptime
         embed.add_field(name="Uptime", value=str(uptime), inline=True)
         embed.add_field(name="Commands", value=str(len(self.bot.commands)), inline=True)
-        embed.add_field(name="Servers", value=str(len(self.bot.guilds)), inline=True)
-        embed.add_field(name="Users", value=str(len(self.bot.users)), inline=True)
+        guild_stats = self.bot.guild_stats
+        servers = len(self.bot.guilds)
+        scope = f" (cluster {self.bot.cluster})" if self.bot.cluster else ""  # Other clusters run in other processes, so they aren't included
+        embed.add_field(name=f"Servers{scope}", value=str(servers), inline=True)
+        members = f"{guild_stats.humans:,} humans, {guild_stats.bots:,} bots"
+        if len(guild_stats.guilds) < servers:  # Guilds that aren't chunked are only counted once someone asks for their counts
+            members += f"\n(in {len(guild_stats.guilds):,} counted servers)"
+        embed.add_field(name=f"Members{scope}", value=members, inline=True)
+        shard_servers = Counter(guild.shard_id for guild in self.bot.guilds)
+        shards = [f"#{shard_id}: {"offline" if shard.is_closed() else latency.milliseconds(shard.latency)}, {shard_servers[shard_id]:,} servers"
+                  for shard_id, shard in sorted(self.bot.shards.items())]
+        if len(shards) > 20:
+            shards[20:] = [f"...and {len(shards) - 20} more"]
+        embed.add_field(name=f"Shards ({len(self.bot.shards)} of {self.bot.shard_count})", value="\n".join(shards) or "None", inline=False)
         embed.add_field(name="Last Update", value=last_update, inline=False)
         return await ctx.send(embed=embed)
 
@@ -50,9 +64,11 @@ class Information(commands.Cog):
 
         embed.add_field(name="Server Name", value=ctx.guild.name, inline=True)
         embed.add_field(name="Server ID", value=ctx.guild.id, inline=True)
-        embed.add_field(name="Server Owner", value=f"{ctx.guild.owner.mention} ({ctx.guild.owner.name})", inline=True)
+        owner = await self.bot.member_lookup.get_member(ctx.guild, ctx.guild.owner_id)
+        embed.add_field(name="Server Owner", value=f"{owner.mention} ({owner.name})" if owner is not None else f"<@{ctx.guild.owner_id}>", inline=True)
         embed.add_field(name="Member Count", value=str(ctx.guild.member_count), inline=True)
-        embed.add_field(name="Bot Count", value=str(sum(1 for member in ctx.guild.members if member.bot)), inline=True)
+        counts = await self.bot.member_lookup.guild_counts(ctx.guild)
+        embed.add_field(name="Bot Count", value=str(counts.bots), inline=True)
         embed.add_field(name="Roles", value=str(len(ctx.guild.roles)), inline=True)
         embed.add_field(name="Channels", value=str(len(ctx.guild.channels)), inline=True)
         embed.add_field(name="Emotes", value=str(len(ctx.guild.emojis)), inline=True)
@@ -72,7 +88,7 @@ class Information(commands.Cog):
         if user is None:
             user = ctx.author
         if ctx.guild is not None:
-            member: discord.Member | None = ctx.guild.get_member(user.id)  # Try to find the user in this guild
+            member: discord.Member | None = await self.bot.member_lookup.get_member(ctx.guild, user.id)  # Try to find the user in this guild
         else:
             member = None
 
@@ -121,7 +137,15 @@ class Information(commands.Cog):
         time2 = time.time()
         await msg.edit(content=f"Message Send: {send:,}ms\nMessage Edit: unknown\nWS Latency: {socket:,}ms")
         edit = int((time.time() - time2) * 1000)
-        await msg.edit(content=f"Message Send: {send:,}ms\nMessage Edit: {edit:,}ms\nWS Latency: {socket:,}ms")
+        history = self.bot.latency_sampler.summary()
+        heartbeat, rest = history["heartbeat"], history["rest"]
+        minutes = self.bot.latency_sampler.history // 60
+        await msg.edit(content=f"Message Send: {send:,}ms\nMessage Edit: {edit:,}ms\nWS Latency: {socket:,}ms\n"
+                               f"Last {minutes:g} minutes ({rest["samples"]:,} samples):\n"
+                               f"- WS Latency: p50 {latency.milliseconds(heartbeat["p50"])}, p95 {latency.milliseconds(heartbeat["p95"])}, "
+                               f"p99 {latency.milliseconds(heartbeat["p99"])}\n"
+                               f"- REST Latency: p50 {latency.milliseconds(rest["p50"])}, p95 {latency.milliseconds(rest["p95"])}, "
+                               f"p99 {latency.milliseconds(rest["p99"])}")
 
     @commands.hybrid_command(name="invite")
     @commands.cooldown(rate=1, per=2, type=commands.BucketType.user)
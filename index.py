@@ -1,48 +1,82 @@
+import argparse
 import asyncio
 import os
+import signal
+import sys
 
 import discord
 
-from utils import bot_data, general
-
-print(f"{general.iso_time()} > Signing Resignation Letter...")
-
-# load stuff from bot's config
-config = general.load_config()
-prefixes = config["prefixes"]
-intents = discord.Intents(members=True, messages=True, guilds=True, bans=True, emojis=True, reactions=True, message_content=True)
-
-activity_type = config["activity_type"]
-activity_message = config["activity_message"]
-match activity_type:
-    case "playing":
-        activity = discord.Game(name=activity_message)
-    case "streaming":
-        activity = discord.Streaming(name=activity_message, url=config["streaming_url"])  # Streaming statuses have a URL element
-    case "listening":
-        activity = discord.Activity(type=discord.ActivityType.listening, name=activity_message)
-    case "watching":
-        activity = discord.Activity(type=discord.ActivityType.watching, name=activity_message)
-    case "custom":
-        activity = discord.CustomActivity(name=activity_message)
-    case "competing":
-        activity = discord.Activity(type=discord.ActivityType.competing, name=activity_message)
-    case _:
-        raise ValueError(f"Unknown activity type {activity_type}")
-
-allowed_mentions = discord.AllowedMentions(everyone=False, roles=False, users=True)
-bot = bot_data.Bot(config=config, command_prefix=prefixes, prefix=prefixes, intents=intents, case_insensitive=True, owner_ids=config["owners"],
-                   activity=activity, status=discord.Status.dnd, allowed_mentions=allowed_mentions)
-
-# Load command categories
-loop = asyncio.get_event_loop_policy().get_event_loop()
-tasks = []
-for file in os.listdir("cogs"):
-    if file.endswith(".py"):
-        tasks.append(loop.create_task(bot.load_extension(f"cogs.{file[:-3]}")))
-tasks.append(loop.create_task(bot.start(config["token"])))
-
-try:
-    loop.run_until_complete(asyncio.gather(*tasks))
-except (KeyboardInterrupt, asyncio.CancelledError, SystemExit):
-    loop.close()
+from utils import bot_data, general, members, sharding
+
+
+def main():
+    print(f"{general.iso_time()} > Signing Resignation Letter...")
+
+    # The cluster launcher (cluster.py) tells each process which shards to run
+    parser = argparse.ArgumentParser(description="Run the bot")
+    parser.add_argument("--cluster", type=int, default=0, help="The number of this cluster (set by cluster.py)")
+    parser.add_argument("--shard-ids", default="", help="Comma-separated shards to run in this process")
+    parser.add_argument("--shard-count", type=int, default=0, help="The total number of shards across all clusters")
+    args = parser.parse_args()
+
+    # load stuff from bot's config
+    config = general.load_config()
+    if args.cluster:
+        sharding.apply_cluster(config, args.cluster, [int(shard_id) for shard_id in args.shard_ids.split(",")], args.shard_count)
+    prefixes = config["prefixes"]
+    intents = discord.Intents(members=True, messages=True, guilds=True, bans=True, emojis=True, reactions=True, message_content=True)
+
+    activity_type = config["activity_type"]
+    activity_message = config["activity_message"]
+    match activity_type:
+        case "playing":
+            activity = discord.Game(name=activity_message)
+        case "streaming":
+            activity = discord.Streaming(name=activity_message, url=config["streaming_url"])  # Streaming statuses have a URL element
+        case "listening":
+            activity = discord.Activity(type=discord.ActivityType.listening, name=activity_message)
+        case "watching":
+            activity = discord.Activity(type=discord.ActivityType.watching, name=activity_message)
+        case "custom":
+            activity = discord.CustomActivity(name=activity_message)
+        case "competing":
+            activity = discord.Activity(type=discord.ActivityType.competing, name=activity_message)
+        case _:
+            raise ValueError(f"Unknown activity type {activity_type}")
+
+    # Without startup chunking and with the member cache turned off, members are looked up (and counted) on demand instead
+    member_cache = config["member_cache"]
+    member_cache_flags = members.member_cache_flags(member_cache)
+
+    try:
+        shard_options = sharding.shard_options(config["sharding"], config["token"])
+    except sharding.GatewayError as e:
+        sys.exit(f"{general.iso_time()} > {e}")
+
+    allowed_mentions = discord.AllowedMentions(everyone=False, roles=False, users=True)
+    bot = bot_data.Bot(config=config, command_prefix=prefixes, prefix=prefixes, intents=intents, case_insensitive=True, owner_ids=config["owners"],
+                       activity=activity, status=discord.Status.dnd, allowed_mentions=allowed_mentions,
+                       chunk_guilds_at_startup=member_cache["chunk_at_startup"], member_cache_flags=member_cache_flags,
+                       **shard_options)
+
+    loop = asyncio.get_event_loop_policy().get_event_loop()
+    try:
+        loop.run_until_complete(start(bot, config["token"]))
+    except (KeyboardInterrupt, asyncio.CancelledError, SystemExit):
+        loop.close()
+
+
+async def start(bot: bot_data.Bot, token: str):
+    """ Load the command categories one at a time in alphabetical order, and only then connect to Discord """
+    extensions = sorted(f"cogs.{file[:-3]}" for file in os.listdir("cogs") if file.endswith(".py"))
+    await bot.startup_report.load_extensions(bot, extensions)
+    try:  # Let running commands finish when the process is asked to stop (e.g. by a service manager)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, bot.lifecycle.request_shutdown)
+    except NotImplementedError:  # Windows
+        pass
+    await bot.start(token)
+
+
+# The image worker processes import this file too, so only start the bot when it is run directly
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,52 @@
 from datetime import datetime
 from typing import override
 
+import aiohttp
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from utils import errors
+from utils import cache, downloads, errors, latency, lifecycle, logs, members, metrics, scheduler, startup, stats, workers
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     def __init__(self, config: dict, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.config: dict = config  # Config stored inside the bot
         self.name: str = config["name"]
         self.uptime: datetime | None = None
+        self.startup_report: startup.StartupReport = startup.StartupReport.from_config(config["startup"])
+        self.cluster: int = config["sharding"]["cluster"]  # 0 unless the bot was started by the cluster launcher
+        log_name = f"{self.name} [cluster {self.cluster}]" if self.cluster else self.name
+        self.logger: logs.Logger = logs.Logger.from_config(log_name, config["logging"])
+        self.metrics: metrics.CommandMetrics = metrics.CommandMetrics.from_config(config["metrics"])
+        self.error_reporter: errors.ErrorReporter = errors.ErrorReporter.from_config(self, config, self.logger)
+        self.lifecycle: lifecycle.Lifecycle = lifecycle.Lifecycle.from_config(self, self.logger, config["lifecycle"])
+        self.add_check(self.lifecycle.check)
+        self.before_invoke(self.lifecycle.command_started)
+        self.after_invoke(self.lifecycle.command_finished)
+        self.latency_sampler: latency.LatencySampler = latency.LatencySampler.from_config(self, self.logger, config["latency"])
+        # These are kept here rather than in the cogs so that they survive cog reloads
+        self.image_pool: workers.ProcessPool = workers.ProcessPool.from_config(config["image_pool"])
+        self.render_cache: cache.RenderCache = cache.RenderCache.from_config(config["render_cache"])
+        self.download_cache: downloads.DownloadCache = downloads.DownloadCache.from_config(config["download_cache"])
+        self.guild_stats: stats.GuildStats = stats.GuildStats()
+        self.member_lookup: members.MemberLookup = members.MemberLookup.from_config(self, self.guild_stats, config["member_cache"])
+        self.scheduler: scheduler.JobScheduler = scheduler.JobScheduler.from_config(config["scheduler"])
+        self.session: aiohttp.ClientSession | None = None  # Used to download images, created once the event loop is running
+
+    @override
+    async def setup_hook(self):
+        self.session = aiohttp.ClientSession()
+        self.logger.start()
+        await self.metrics.start()
+        self.error_reporter.start()
+        self.latency_sampler.start()
+
+    @override
+    async def get_context(self, origin: discord.Message | discord.Interaction, /, *, cls: type[commands.Context] = metrics.TimedContext) -> commands.Context:
+        # Used for both text commands and the slash versions of hybrid commands, so every command gets timed
+        return await super().get_context(origin, cls=cls)
 
     @override
     async def on_message(self, message: discord.Message):
@@ -22,10 +55,30 @@ class Bot(commands.Bot):
             return
         await self.process_commands(message)
 
+    @override
+    async def close(self):
+        self.image_pool.shutdown()
+        if self.session is not None:
+            await self.session.close()
+        await self.metrics.close()
+        await self.latency_sampler.close()
+        await self.error_reporter.close()  # Still needs the connection to send the last digests
+        await super().close()
+        await self.logger.close()  # Last, so that everything logged while shutting down is still written
+
     @override
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
         """ Handle command errors """
-        return await errors.on_command_error(ctx, error)
+        original = error.original if isinstance(error, commands.HybridCommandError) else error
+        # Only errors raised while the command was running count - cooldowns, failed checks and bad arguments reject it before it runs,
+        # so they aren't the command's fault and don't say anything about how long it takes
+        if isinstance(original, (commands.CommandInvokeError, app_commands.CommandInvokeError)):
+            self.metrics.record(ctx, failed=True)
+        try:
+            return await errors.on_command_error(ctx, error)
+        finally:
+            # Hybrid commands used as slash commands don't call the after-invoke hook if they fail
+            await self.lifecycle.command_finished(ctx)
 
     @staticmethod
     async def on_slash_command_error(ctx: discord.Interaction, error: app_commands.AppCommandError):
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+from collections import OrderedDict
+
+
+class RenderCache:
+    """ Two-tier cache for rendered filter outputs
+
+     The first tier is an in-memory LRU cache limited by the total size of the stored images.
+     The optional second tier stores the images as files on disk, and is also limited by their total size. """
+
+    def __init__(self, memory_bytes: int, disk_path: str = "", disk_bytes: int = 0, random_variants: int = 0):
+        self.memory: OrderedDict[str, tuple[bytes, str]] = OrderedDict()  # key -> (image, file extension), oldest first
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0
+        self.disk_path = disk_path
+        self.disk: OrderedDict[str, tuple[str, int]] = OrderedDict()  # key -> (file path, file size), oldest first
+        self.disk_bytes = disk_bytes
+        self.disk_used = 0
+        self.random_variants = random_variants
+        """ How many different outputs to keep for non-deterministic filters (0 means they are never cached) """
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if self.disk_path:
+            self._load_disk_index()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RenderCache":
+        """ Create a render cache from its section of the config """
+        return cls(memory_bytes=config["memory_bytes"], disk_path=config["disk_path"], disk_bytes=config["disk_bytes"], random_variants=config["random_variants"])
+
+    def _load_disk_index(self):
+        """ Find the files already stored in the disk cache, so that they survive restarts """
+        os.makedirs(self.disk_path, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_path):
+            if entry.name.endswith(".tmp"):  # Left behind by a write that never finished
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, entry.path, stat.st_size))
+        for _, name, path, size in sorted(entries):
+            key = name.split(".")[0]
+            self.disk[key] = (path, size)
+            self.disk_used += size
+        self._trim_disk()
+
+    def make_key(self, source: str, filter_name: str, deterministic: bool = True) -> str | None:
+        """ Build the cache key for a filter applied to an image
+
+         source should identify the image's contents, such as an asset key or a hash of the file.
+         Non-deterministic filters are cached per variant: each request picks one of the variants at random,
+         so repeated requests still give different results while reusing the outputs rendered earlier.
+         Returns None if the output should not be cached at all. """
+        if deterministic:
+            variant = 0
+        elif self.random_variants > 0:
+            variant = random.randrange(self.random_variants)
+        else:
+            return None
+        return hashlib.sha256(f"{source}:{filter_name}:{variant}".encode()).hexdigest()
+
+    async def get(self, key: str) -> tuple[bytes, str] | None:
+        """ Get the stored image and its file extension, or None if it is not cached """
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.disk:
+            path, _ = self.disk[key]
+            try:
+                data = await asyncio.to_thread(self._read_file, path)
+            except OSError:  # The file was deleted from under us
+                self._forget_file(key)
+            else:
+                self.disk_hits += 1
+                self.disk.move_to_end(key)
+                extension = path.rsplit(".", 1)[-1]
+                self._store_in_memory(key, data, extension)
+                return data, extension
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes, extension: str):
+        """ Store the image in both tiers of the cache """
+        self._store_in_memory(key, data, extension)
+        if self.disk_path and len(data) <= self.disk_bytes and key not in self.disk:
+            path = os.path.join(self.disk_path, f"{key}.{extension}")
+            await asyncio.to_thread(self._write_file, path, data)
+            if key not in self.disk:  # Another request may have stored the same image in the meantime
+                self.disk[key] = (path, len(data))
+                self.disk_used += len(data)
+                self._trim_disk()
+
+    def _store_in_memory(self, key: str, data: bytes, extension: str):
+        """ Store the image in the in-memory tier, evicting the least recently used images if needed """
+        if len(data) > self.memory_bytes or key in self.memory:
+            return
+        self.memory[key] = (data, extension)
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_bytes:
+            _, (evicted, _) = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted)
+            self.evictions += 1
+
+    def _trim_disk(self):
+        """ Delete the least recently used files until the disk tier fits its limit """
+        while self.disk_used > self.disk_bytes:
+            key = next(iter(self.disk))
+            path, _ = self.disk[key]
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._forget_file(key)
+            self.disk_evictions += 1
+
+    def _forget_file(self, key: str):
+        """ Remove a file from the disk index """
+        _, size = self.disk.pop(key)
+        self.disk_used -= size
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        """ Read a cached file and mark it as recently used """
+        with open(path, "rb") as file:
+            data = file.read()
+        os.utime(path)
+        return data
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        """ Write a cached file
+
+         The data is written to a temporary file first, which is then renamed into place,
+         so that a crash halfway through never leaves a truncated image that would be indexed on the next start. """
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def stats(self) -> dict[str, int]:
+        """ Get the cache's counters """
+        return {
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_used,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_used,
+        }
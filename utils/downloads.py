@@ -0,0 +1,119 @@
+import re
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+
+CHUNK_SIZE = 65536
+MAX_AGE_REGEX = re.compile(r"max-age=(\d+)")
+
+
+class DownloadTooLarge(ValueError):
+    """ Exception raised when a file is larger than the download limit """
+    def __init__(self, text: str, limit: int):
+        super().__init__(text)
+        self.limit = limit
+        """ The download limit (in bytes) that the file exceeded """
+
+
+async def read(session: aiohttp.ClientSession, url: str, max_bytes: int) -> bytes:
+    """ Download a file, giving up as soon as it turns out to be larger than max_bytes """
+    async with session.get(url) as response:
+        return await _read_response(response, max_bytes)
+
+
+async def _read_response(response: aiohttp.ClientResponse, max_bytes: int) -> bytes:
+    """ Read the response's body in chunks, so that no more than max_bytes (plus one chunk) is ever kept in memory """
+    response.raise_for_status()
+    if response.content_length is not None and response.content_length > max_bytes:
+        raise DownloadTooLarge(f"The file is {response.content_length:,} bytes large, which is above the limit of {max_bytes:,} bytes", max_bytes)
+    data = bytearray()
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        data += chunk
+        if len(data) > max_bytes:
+            raise DownloadTooLarge(f"The file is larger than the limit of {max_bytes:,} bytes", max_bytes)
+    return bytes(data)
+
+
+class CachedDownload:
+    """ A downloaded file, along with what is needed to tell whether it is still up to date """
+    __slots__ = ("data", "etag", "expires")
+
+    def __init__(self, data: bytes, etag: str | None, expires: float):
+        self.data = data
+        self.etag = etag
+        self.expires = expires
+
+
+class DownloadCache:
+    """ In-memory LRU cache of downloaded files, limited by their total size
+
+     Files are reused without any request until the server's max-age runs out (or default_ttl, if the server doesn't say).
+     After that, the file is revalidated using its ETag, so it only has to be downloaded again if it actually changed. """
+
+    def __init__(self, max_bytes: int, default_ttl: float):
+        self.entries: OrderedDict[str, CachedDownload] = OrderedDict()  # key -> file, oldest first
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.default_ttl = default_ttl
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "DownloadCache":
+        """ Create a download cache from its section of the config """
+        return cls(max_bytes=config["max_bytes"], default_ttl=config["default_ttl"])
+
+    async def read(self, session: aiohttp.ClientSession, key: str, url: str, max_bytes: int) -> bytes:
+        """ Get the file stored under the key, downloading it from the URL if it's not cached or no longer up to date """
+        entry = self.entries.get(key)
+        headers = {}
+        if entry is not None:
+            self.entries.move_to_end(key)
+            if time.time() < entry.expires:
+                self.hits += 1
+                return entry.data
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and entry is not None:  # Not modified
+                self.revalidated += 1
+                entry.expires = self._expires(response)
+                return entry.data
+            data = await _read_response(response, max_bytes)
+            self.misses += 1
+            self._store(key, CachedDownload(data, response.headers.get("ETag"), self._expires(response)))
+        return data
+
+    def _expires(self, response: aiohttp.ClientResponse) -> float:
+        """ Find out when the response stops being fresh, from its Cache-Control header """
+        match = MAX_AGE_REGEX.search(response.headers.get("Cache-Control", ""))
+        return time.time() + (int(match.group(1)) if match else self.default_ttl)
+
+    def _store(self, key: str, entry: CachedDownload):
+        """ Store the file, evicting the least recently used files if the cache gets too large """
+        if key in self.entries:
+            self.used -= len(self.entries.pop(key).data)
+        if len(entry.data) > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.used += len(entry.data)
+        while self.used > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.used -= len(evicted.data)
+            self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        """ Get the cache's counters """
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.used,
+        }
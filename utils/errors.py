@@ -1,8 +1,149 @@
+import asyncio
+import hashlib
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from utils import general
+from utils import general, lifecycle, logs
+
+
+class ErrorDigest:
+    """ All occurrences of the same error within one reporting window """
+    __slots__ = ("error_message", "traceback", "count", "first_seen", "last_seen", "content", "guild")
+
+    def __init__(self, error: BaseException, content: str, guild: str):
+        self.error_message = f"{type(error).__name__}: {error}"
+        self.traceback = ""  # Set by add()
+        self.count = 0
+        self.first_seen: datetime = general.now()
+        self.last_seen: datetime = self.first_seen
+        self.content = content  # The command that caused the latest occurrence (the traceback is from the same one)
+        self.guild = guild
+
+    def add(self, error: BaseException, content: str, guild: str):
+        """ Count another occurrence, keeping its traceback together with its command and guild """
+        self.count += 1
+        self.last_seen = general.now()
+        self.traceback = general.make_traceback(error)
+        self.content, self.guild = content, guild
+
+    def merge(self, older: "ErrorDigest"):
+        """ Add the occurrences of an older digest of the same error, which failed to be sent """
+        self.count += older.count
+        self.first_seen = older.first_seen
+
+    def format(self) -> str:
+        """ Format the digest as a message for the errors channel """
+        if self.count > 1:
+            header = f"**{self.count}×** between {general.iso_time(self.first_seen)} and {general.iso_time(self.last_seen)} (showing the latest occurrence)\n"
+        else:
+            header = ""
+        return f"{header}Command: {self.content[:250]}\nGuild: {self.guild}\n{self.traceback}"[:2000]  # Make sure the error message fits the limits
+
+
+class ErrorReporter:
+    """ Sends unhandled errors to the errors channel from a background task, as one digest per distinct error
+
+     Errors are fingerprinted by their type and the frames of their traceback, and counted over a window of window seconds,
+     so a burst of the same error becomes a single message instead of hitting the rate limits (and delaying real command replies).
+     No more than max_per_window digests are sent per window. Digests that can't be sent are kept for the next window,
+     up to max_pending distinct errors - beyond that, errors only go to the log. """
+
+    def __init__(self, bot: commands.Bot, channel_id: int, logger: logs.Logger, window: float, max_per_window: int, max_pending: int):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.logger = logger
+        self.window = window
+        self.max_per_window = max_per_window
+        self.max_pending = max_pending
+        self.pending: OrderedDict[str, ErrorDigest] = OrderedDict()  # fingerprint -> digest, oldest first
+        self.dropped = 0
+        self.stopping = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    @classmethod
+    def from_config(cls, bot: commands.Bot, config: dict, logger: logs.Logger) -> "ErrorReporter":
+        """ Create an error reporter from the errors_channel and the error_reports section of the config """
+        options = config["error_reports"]
+        return cls(bot, config["errors_channel"], logger, window=options["window"], max_per_window=options["max_per_window"], max_pending=options["max_pending"])
+
+    @staticmethod
+    def fingerprint(error: BaseException) -> str:
+        """ Identify the error by its type and where it was raised from, ignoring its message (which often has IDs and such in it) """
+        frames = "|".join(f"{frame.filename}:{frame.lineno}:{frame.name}" for frame in traceback.extract_tb(error.__traceback__))
+        return hashlib.sha1(f"{type(error).__module__}.{type(error).__qualname__}|{frames}".encode()).hexdigest()
+
+    def report(self, error: BaseException, content: str, guild: str):
+        """ Add an error to the next digest - this never waits for Discord """
+        key = self.fingerprint(error)
+        digest = self.pending.get(key)
+        if digest is None:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1  # It was already logged, it just won't be sent to the errors channel
+                return
+            digest = self.pending[key] = ErrorDigest(error, content, guild)
+        digest.add(error, content, guild)
+
+    def start(self):
+        """ Start sending digests in the background """
+        if self.task is None:
+            self.task = asyncio.create_task(self._sender())
+
+    async def close(self):
+        """ Send whatever is still pending, and stop the background task
+
+         Anything that still can't be sent (e.g. more than max_per_window digests) is summarised in the log instead. """
+        self.stopping.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        self._drop_pending("the bot is shutting down")
+
+    async def _sender(self):
+        """ Send the pending digests once per window """
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=self.window)
+            except TimeoutError:
+                pass
+            await self._flush()
+
+    async def _flush(self):
+        """ Send up to max_per_window digests, keeping the rest (and any that fail to send) for the next window """
+        if self.dropped:
+            self.logger.error("error_reports_dropped", f"{self.dropped} errors were not sent to the errors channel, as too many different errors were pending",
+                              count=self.dropped)
+            self.dropped = 0
+        channel = self.bot.get_channel(self.channel_id)
+        if channel is None:
+            self._drop_pending("the errors channel was not found")  # Every error has already been logged on its own
+            return
+        for _ in range(min(self.max_per_window, len(self.pending))):
+            # Take the digest out while it's being sent, so that errors reported in the meantime start a new one instead of being lost
+            key, digest = self.pending.popitem(last=False)
+            try:
+                await channel.send(digest.format())
+            except discord.HTTPException as e:
+                self.logger.error("error_report_failed", f"Could not send an error report: {type(e).__name__}: {e}")
+                if key in self.pending:
+                    self.pending[key].merge(digest)
+                else:
+                    self.pending[key] = digest
+                self.pending.move_to_end(key, last=False)
+                break  # Try again next window
+
+    def _drop_pending(self, reason: str):
+        """ Give up on the pending digests, leaving a summary of them in the log """
+        if not self.pending:
+            return
+        occurrences = sum(digest.count for digest in self.pending.values())
+        self.logger.error("error_reports_dropped", f"{len(self.pending)} different errors ({occurrences} in total) were not sent to the errors channel, "
+                                                   f"as {reason}", count=occurrences, errors=len(self.pending))
+        self.pending.clear()
 
 
 async def on_command_error(ctx: commands.Context | discord.Interaction, error: commands.CommandError | app_commands.AppCommandError):
@@ -86,6 +227,8 @@ async def on_command_error(ctx: commands.Context | discord.Interaction, error: c
         message = f"I am missing these required permissions: `{"`, `".join(error.missing_permissions)}`"
     elif isinstance(error, (commands.CommandOnCooldown, app_commands.CommandOnCooldown)):
         message = f"This command is currently on cooldown. Retry in {error.retry_after:.2f} seconds..."
+    elif isinstance(error, lifecycle.ShuttingDown):  # The bot is restarting, or the command is being reloaded
+        message = str(error)
     elif isinstance(error, (commands.CheckFailure, app_commands.CheckFailure)):
         message = "You can't use this command here..."
     elif isinstance(error, (commands.CommandNotFound, commands.DisabledCommand)):
@@ -105,9 +248,7 @@ async def on_command_error(ctx: commands.Context | discord.Interaction, error: c
         await ctx.send(message, ephemeral=True)
 
     if not ignore:
-        error_message = f"{general.iso_time()} > {ctx.bot.name} > {guild} > {ctx.author} ({ctx.author.id}) > {content} > {error_message}"
-        general.print_stderr(error_message)
-        errors_channel = ctx.bot.get_channel(ctx.bot.config["errors_channel"])
-        if errors_channel is not None:
-            error_traceback = f"Command: {content[:250]}\nGuild: {guild}\n{general.make_traceback(error)}"
-            await errors_channel.send(error_traceback[:2000])  # Make sure the error message fits the limits
+        ctx.bot.logger.error("command_error", f"{guild} > {ctx.author} ({ctx.author.id}) > {content} > {error_message}",
+                             guild_id=getattr(ctx.guild, "id", None), shard_id=getattr(ctx.guild, "shard_id", None), user_id=ctx.author.id,
+                             command=content, error=error_message)
+        ctx.bot.error_reporter.report(error, content, guild)
@@ -1,10 +1,15 @@
+import importlib.util
 import json
+import os
 import random
 import sys
 import traceback
+import types
 from datetime import datetime
+from typing import TYPE_CHECKING
 
-import discord
+if TYPE_CHECKING:  # Only needed for type hints, so that the image worker processes don't have to load discord.py
+    import discord
 
 
 def load_config():
@@ -12,6 +17,18 @@ def load_config():
     return json.load(open("config.json", "r", encoding="utf-8"))
 
 
+def lazy_import(name: str) -> types.ModuleType:
+    """ Import a module only once one of its attributes is first used, so that heavy modules don't slow down startup """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
 def make_traceback(error: BaseException) -> str:
     """ Make the error traceback string """
     if hasattr(error, "__traceback__"):
@@ -32,7 +49,7 @@ def random_colour() -> int:
     return random.randint(0, 0xffffff)
 
 
-def slash_command_string(interaction: discord.Interaction) -> str:
+def slash_command_string(interaction: "discord.Interaction") -> str:
     """ Get the slash command string from an interaction """
     command = "/" + interaction.command.qualified_name
     arguments: list[str] = []
@@ -64,3 +81,25 @@ def human_time(when: datetime = None) -> str:
 def parse_time(when: str) -> datetime:
     """ Parse the provided time from a string """
     return datetime.fromisoformat(when)
+
+
+def memory_usage(peak: bool = False) -> tuple[int, bool] | None:
+    """ Get how much memory this process uses (its resident set size) in bytes - the current amount, or the most it has used if peak is set
+
+     Also returns whether the amount is the peak: only Linux tells the current amount, so elsewhere the peak is returned either way.
+     Returns None if neither can be found out (e.g. on Windows). """
+    try:
+        with open("/proc/self/status", encoding="utf-8") as file:
+            field = "VmHWM:" if peak else "VmRSS:"
+            for line in file:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024, peak
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere, and a spawned process may inherit its parent's value
+    maximum = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (maximum if sys.platform == "darwin" else maximum * 1024), True
@@ -1,12 +1,44 @@
+import ctypes
+import functools
+import itertools
+import random
+import struct
+import zlib
+from collections import deque
+from collections.abc import Generator, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Callable, Concatenate
+from typing import BinaryIO, Callable, Concatenate
 
-from PIL import Image, ImageFilter, ImageOps, ImageEnhance
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageEnhance, GifImagePlugin, PngImagePlugin, UnidentifiedImageError  # UnidentifiedImageError is for the images cog
 from PIL.Image import Palette, Resampling
 from PIL.ImageSequence import Iterator
 
+from utils import general
+
 MAX_SIZE = 512 * 512
 MAX_FRAMES = 100
+MAX_CHAIN_LENGTH = 5
+FRAME_CHUNK_SIZE = 4
+""" How many frames each thread filters at a time when animated images are filtered in parallel """
+MAX_FRAME_BYTES = 64 * 2 ** 20
+""" Images whose frames would take up more than this much memory once decoded are rejected before decoding them """
+MAX_DECODED_PIXELS = 100_000_000
+""" Animated images are cut short so that no more than this many pixels are decoded across all of their frames """
+ANIMATED_FORMATS: dict[str, str] = {"gif": "gif", "gif_global": "gif", "webp": "webp", "apng": "png"}
+""" The formats that animated images can be saved in, and their file extensions """
+DEFAULT_EFFORT = 4
+DEFAULT_QUALITY = 80
+PIPELINE_VERSION = 1
+""" Bump this whenever a change to the pipeline changes its outputs, so that outputs cached on disk by an older version are no longer used """
+TRANSPARENT_INDEX = 255
+TRANSPARENCY_MASK_LUT = [255] * 128 + [0] * 128
+""" Pixels that are less than half opaque become fully transparent in GIFs """
+MAX_PALETTE_ERROR = 48
+""" How far (in any channel) a pixel can be from its colour in the global palette before it counts as not covered """
+MAX_PALETTE_ERROR_PIXELS = 0.0005
+""" The fraction of a frame's pixels that can be not covered by the global palette before the frame gets its own colour table """
+SWATCH_SIZE = 512
 
 
 def load_from_bytes(image: bytes) -> Image.Image:
@@ -14,25 +46,243 @@ def load_from_bytes(image: bytes) -> Image.Image:
     return Image.open(BytesIO(image))
 
 
-def save_to_bio(image: Image.Image | list[Image.Image]) -> BytesIO:
-    """ Save an image to a BytesIO object """
+def save_to_bio(image: Image.Image | list[Image.Image], animated_format: str = "gif", effort: int = DEFAULT_EFFORT, quality: int = DEFAULT_QUALITY) -> BytesIO:
+    """ Save an image to a BytesIO object
+
+     Still images are saved as PNG, while animated images are saved in the given format (see ANIMATED_FORMATS).
+     effort goes from 0 (fastest) to 6 (smallest output), and quality (0-100) is only used for WebP. """
     bio = BytesIO()
     if isinstance(image, list):  # A sequence of frames of an animated image
-        # The loop parameter is stored in the frame info, but specify it here just in case
-        # The disposal=2 parameter means that frames do not linger, which prevents weird outputs for transparent gifs
-        image[0].save(bio, format="GIF", append_images=image[1:], save_all=True, loop=image[0].info.get("loop", 1), disposal=2)
+        match animated_format:
+            case "gif":
+                # The loop parameter is stored in the frame info, but specify it here just in case
+                # The disposal=2 parameter means that frames do not linger, which prevents weird outputs for transparent gifs
+                image[0].save(bio, format="GIF", append_images=image[1:], save_all=True, loop=image[0].info.get("loop", 1), disposal=2)
+            case "gif_global":
+                _write_gif(image, bio, global_palette=True, effort=effort)
+            case "webp":
+                # WebP and APNG need whole frames, so that every frame replaces the previous one rather than being drawn on top of it
+                image[0].save(bio, format="WEBP", append_images=image[1:], save_all=True, loop=image[0].info.get("loop", 1), duration=_durations(image),
+                              quality=quality, method=effort)
+            case "apng":
+                frames = [frame.convert("RGBA") for frame in image]  # APNG frames all have to use the same mode
+                frames[0].save(bio, format="PNG", append_images=frames[1:], save_all=True, loop=image[0].info.get("loop", 1), duration=_durations(image),
+                               disposal=PngImagePlugin.Disposal.OP_BACKGROUND, blend=PngImagePlugin.Blend.OP_SOURCE, compress_level=1 + round(effort * 4 / 3))
+            case _:
+                raise ValueError(f"Unknown animated image format {animated_format}")
     else:
         image.save(bio, "PNG")
     bio.seek(0)
     return bio
 
 
-def save_to_bytes(image: Image.Image | list[Image.Image]) -> bytes:
+def save_to_bytes(image: Image.Image | list[Image.Image], animated_format: str = "gif", effort: int = DEFAULT_EFFORT, quality: int = DEFAULT_QUALITY) -> bytes:
     """ Save an image into a regular Python bytes object """
-    bio = save_to_bio(image)
+    bio = save_to_bio(image, animated_format, effort, quality)
     return bio.read()
 
 
+def stream_to_bio(frames: Iterable[Image.Image], animated_format: str = "gif", effort: int = DEFAULT_EFFORT, quality: int = DEFAULT_QUALITY) -> BytesIO:
+    """ Save the frames of an animated image, encoding each frame as soon as it is produced
+
+     Unlike save_to_bio, this only holds one frame in memory at a time, so frames can come straight from a generator.
+     This only works for GIFs (with a global palette, the first few frames are kept to calculate it) -
+     Pillow's WebP and APNG encoders need all the frames at once, so those formats still collect every frame first. """
+    if animated_format in ("gif", "gif_global"):
+        bio = BytesIO()
+        _write_gif(frames, bio, global_palette=animated_format == "gif_global", effort=effort)
+        bio.seek(0)
+        return bio
+    return save_to_bio(list(frames), animated_format, effort, quality)
+
+
+def _durations(frames: list[Image.Image]) -> list[int]:
+    """ Get the duration of each frame in milliseconds """
+    return [round(frame.info.get("duration", 0)) for frame in frames]
+
+
+def _write_gif(frames: Iterable[Image.Image], fp: BinaryIO, global_palette: bool = False, effort: int = DEFAULT_EFFORT):
+    """ Write an animated GIF one frame at a time
+
+     Without a global palette, every frame is quantized on its own and gets its own colour table.
+     With a global palette, one palette is calculated from a sample of the frames and shared by every frame that it covers,
+     which is faster, makes the file smaller, and stops colours from flickering between frames.
+     A frame with colours that the palette doesn't cover (e.g. ones that only show up after the sampled frames) gets its own colour table instead.
+     Like Pillow's own writer, every frame after the first is cropped to the area that isn't transparent,
+     and frames that are identical to the previous one are merged into it by adding up their durations.
+     Only the previous frame is held back (until it's known whether the next one repeats it), so frames can still come from a generator. """
+    palette = None
+    if global_palette:
+        if isinstance(frames, list):  # Every frame is already available, so sample them from across the whole animation
+            count = min(len(frames), 1 + effort * 2)  # More effort means that more frames are used for the palette
+            sample = [frames[index * len(frames) // count] for index in range(count)]
+        else:
+            frames = iter(frames)
+            sample = list(itertools.islice(frames, 1 + effort * 2))
+            frames = itertools.chain(sample, frames)
+        palette = _global_palette(sample, effort)
+    pending: tuple[Image.Image, tuple[int, int, int, int], dict] | None = None  # The last frame, its area, and its parameters
+    for frame in frames:
+        frame, local_palette = _gif_frame(frame, palette)
+        if pending is None:
+            # The global header uses the first frame's palette (which is the global palette if there is one)
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": frame.info.get("loop", 1)})
+            fp.write(b"".join(header))
+            bbox = (0, 0) + frame.size
+        elif _same_frame(pending[0], frame):
+            pending[2]["duration"] += frame.info.get("duration", 0)
+            continue
+        else:
+            _write_gif_frame(fp, *pending)
+            bbox = _gif_bbox(frame)
+        params = {"include_color_table": local_palette, "duration": frame.info.get("duration", 0), "disposal": 2}
+        if "transparency" in frame.info:
+            params["transparency"] = frame.info["transparency"]
+        pending = (frame, bbox, params)
+    if pending is not None:
+        _write_gif_frame(fp, *pending)
+    fp.write(b";")  # End of the GIF file
+
+
+def _write_gif_frame(fp: BinaryIO, frame: Image.Image, bbox: tuple[int, int, int, int], params: dict):
+    """ Write the area of the frame inside the bounding box """
+    if bbox != (0, 0) + frame.size:
+        frame = frame.crop(bbox)
+    if params["include_color_table"]:
+        frame, params = _shrink_palette(frame, params)
+    fp.write(b"".join(GifImagePlugin.getdata(frame, offset=bbox[:2], **params)))
+
+
+def _shrink_palette(frame: Image.Image, params: dict) -> tuple[Image.Image, dict]:
+    """ Drop the colours that the frame doesn't use from its own colour table, so that it takes fewer bits per pixel (as Pillow does) """
+    used = [index for index, count in enumerate(frame.histogram()) if count]
+    if len(used) == len(frame.getpalette()) // 3:
+        return frame, params
+    frame = frame.remap_palette(used)
+    if "transparency" in params:
+        params = dict(params)
+        if params["transparency"] in used:
+            params["transparency"] = used.index(params["transparency"])
+        else:  # None of the frame's pixels are transparent
+            del params["transparency"]
+    return frame, params
+
+
+def _gif_bbox(frame: Image.Image) -> tuple[int, int, int, int]:
+    """ Find the area of the frame that isn't transparent - every frame is cleared before the next one is drawn, so nothing else has to be written """
+    if "transparency" not in frame.info:
+        return (0, 0) + frame.size
+    transparency = frame.info["transparency"]
+    indices = Image.frombytes("L", frame.size, frame.tobytes())  # The palette indices, without the palette
+    bbox = indices.point([0 if index == transparency else 255 for index in range(256)]).getbbox()
+    return bbox or (0, 0, 1, 1)  # A GIF frame can't be empty, so write a single transparent pixel
+
+
+def _same_frame(previous: Image.Image, frame: Image.Image) -> bool:
+    """ Check whether two frames look the same """
+    if previous.size != frame.size:
+        return False
+    if previous.getpalette() == frame.getpalette() and previous.info.get("transparency") == frame.info.get("transparency"):
+        return previous.tobytes() == frame.tobytes()
+    return previous.convert("RGBA").tobytes() == frame.convert("RGBA").tobytes()
+
+
+def _global_palette(frames: list[Image.Image], effort: int) -> Image.Image:
+    """ Calculate a palette of 255 colours from the frames, leaving the last colour for transparency """
+    width = 128
+    thumbnails = [frame.convert("RGB").resize((width, max(1, frame.height * width // frame.width))) for frame in frames]
+    montage = Image.new("RGB", (width, sum(thumbnail.height for thumbnail in thumbnails)))
+    y = 0
+    for thumbnail in thumbnails:
+        montage.paste(thumbnail, (0, y))
+        y += thumbnail.height
+    method = Image.Quantize.MEDIANCUT if effort >= 4 else Image.Quantize.FASTOCTREE
+    palette = montage.quantize(colors=255, method=method).getpalette()
+    # Fill the unused colours with copies of the first colour - when looking for the closest colour, the first match wins,
+    # so none of the pixels get mapped onto the copies or onto the transparent colour
+    palette += palette[:3] * (256 - len(palette) // 3)
+    palette_image = Image.new("P", (1, 1))
+    palette_image.putpalette(palette)
+    return palette_image
+
+
+def _gif_frame(frame: Image.Image, palette: Image.Image | None = None) -> tuple[Image.Image, bool]:
+    """ Convert a frame into a palette image that can be written to a GIF, and tell whether it needs its own colour table
+
+     If a global palette is given, the frame is mapped onto it (without dithering), and colour 255 is used for transparency.
+     If that changes too many of the frame's pixels too much, the frame gets its own palette instead. """
+    if palette is not None:
+        info = frame.info
+        frame = frame.convert("RGBA")
+        rgb = frame.convert("RGB")
+        output = rgb.quantize(palette=palette, dither=Image.Dither.NONE)
+        opaque = frame.getchannel("A").point(TRANSPARENCY_MASK_LUT[::-1])
+        if _palette_error(rgb, output, opaque) <= MAX_PALETTE_ERROR_PIXELS * frame.width * frame.height:
+            output.paste(TRANSPARENT_INDEX, mask=ImageChops.invert(opaque))
+            output.info = {key: value for key, value in info.items() if key in ("duration", "loop")}
+            output.info["transparency"] = TRANSPARENT_INDEX
+            return output, False
+        frame.info = info
+    if frame.mode not in ("P", "L"):
+        frame = frame.convert("RGBA").convert("P", palette=Palette.ADAPTIVE)
+        frame.info.pop("transparency", None)  # Any transparency info copied over from the original frame is no longer valid
+    if frame.mode == "P" and frame.palette.mode == "RGBA" and "transparency" not in frame.info:
+        for rgba, index in frame.palette.colors.items():
+            if rgba[3] == 0:  # Use the first fully transparent colour as the GIF's transparent colour
+                frame.info["transparency"] = index
+                break
+    return frame, True
+
+
+def _palette_error(rgb: Image.Image, mapped: Image.Image, opaque: Image.Image) -> int:
+    """ Count the opaque pixels where mapping onto the palette changed a channel by more than MAX_PALETTE_ERROR """
+    r, g, b = ImageChops.difference(rgb, mapped.convert("RGB")).split()
+    error = ImageChops.multiply(ImageChops.lighter(ImageChops.lighter(r, g), b), opaque)  # The largest difference of each pixel, 0 where transparent
+    return sum(error.histogram()[MAX_PALETTE_ERROR + 1:])
+
+
+class _MallInfo2(ctypes.Structure):
+    """ The structure returned by glibc's mallinfo2() """
+    _fields_ = [(name, ctypes.c_size_t) for name in ("arena", "ordblks", "smblks", "hblks", "hblkhd", "usmblks", "fsmblks", "uordblks", "fordblks", "keepcost")]
+
+
+try:
+    _libc = ctypes.CDLL("libc.so.6")
+    _libc.mallinfo2.restype = _MallInfo2
+except (OSError, AttributeError):  # Not using glibc 2.33 or newer
+    _libc = None
+
+
+class PeakMemory:
+    """ Tracks the peak memory used during a job
+
+     Pillow allocates its images with malloc, so where possible this measures the bytes currently allocated by malloc.
+     Otherwise, it falls back to the process's RSS, which is less precise because freed memory is not always returned to the OS.
+     The memory is only measured when sample() is called, so take samples at the points where the most data is alive. """
+
+    def __init__(self):
+        self.baseline = self.current()
+        self.peak = self.baseline
+
+    @staticmethod
+    def current() -> int:
+        """ Get the current memory usage in bytes """
+        if _libc is not None:
+            info = _libc.mallinfo2()
+            return info.uordblks + info.hblkhd  # Allocated chunks, plus large allocations that get their own memory mapping
+        usage = general.memory_usage()
+        return usage[0] if usage is not None else 0
+
+    def sample(self):
+        """ Record the current memory usage """
+        self.peak = max(self.peak, self.current())
+
+    @property
+    def used(self) -> int:
+        """ How many bytes above the baseline the memory usage has peaked at """
+        return self.peak - self.baseline
+
+
 class InvalidLength(ValueError):
     """ Exception raised when the specified colour is of invalid length """
     def __init__(self, text: str, value: str, length: int):
@@ -50,6 +300,17 @@ class InvalidColour(ValueError):
         self.error = error
 
 
+class ImageRejected(ValueError):
+    """ Exception raised when an image is too large to be decoded safely """
+
+
+class InvalidFilter(ValueError):
+    """ Exception raised when a filter chain contains an unknown filter or too many filters """
+    def __init__(self, text: str, value: str):
+        super().__init__(text)
+        self.value = value
+
+
 def colour_hex_to_tuple(colour: str) -> tuple[int, int, int]:
     """ Convert a hexadecimal colour string into an (r, g, b) tuple """
     return colour_int_to_tuple(colour_hex_to_int(colour))
@@ -78,58 +339,259 @@ def colour_int_to_tuple(colour: int) -> tuple[int, int, int]:
     return r, g, b
 
 
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    """ Build a PNG chunk: its length, type, data, and checksum """
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+# A solid colour swatch is a 1-bit palette PNG where every pixel points at the only colour in the palette,
+# so the compressed pixel data is the same for every colour and only the palette has to change
+_SWATCH_HEADER = b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", SWATCH_SIZE, SWATCH_SIZE, 1, 3, 0, 0, 0))
+_SWATCH_PIXELS = _png_chunk(b"IDAT", zlib.compress((b"\x00" * (1 + SWATCH_SIZE // 8)) * SWATCH_SIZE, 9)) + _png_chunk(b"IEND", b"")
+
+
+@functools.lru_cache(maxsize=256)
+def colour_swatch(colour: int) -> bytes:
+    """ Get a 512x512 PNG filled with the colour, without going through Pillow at all """
+    return _SWATCH_HEADER + _png_chunk(b"PLTE", bytes(colour_int_to_tuple(colour))) + _SWATCH_PIXELS
+
+
 def calculate_brightness(red: int | float, green: int | float, blue: int | float) -> float:
     """ Calculate the perceived brightness of a colour """
     # Source: https://stackoverflow.com/a/596243
     return 0.2126 * red + 0.7152 * green + 0.0722 * blue
 
 
+# Colour operations
+# These run entirely in Pillow's C code: a lookup table (LUT) maps every value of a channel to a new value,
+# and a colour matrix mixes the red, green and blue channels together. The alpha channel is always passed through untouched.
+type LUT = list[int]
+type ColourMatrix = tuple[float, ...]
+
+IDENTITY_LUT: LUT = list(range(256))
+INVERT_LUT: LUT = [255 - value for value in range(256)]
+SEPIA_MATRIX: ColourMatrix = (  # https://stackoverflow.com/a/9449159
+    0.393, 0.769, 0.189, 0,
+    0.349, 0.686, 0.168, 0,
+    0.272, 0.534, 0.131, 0,
+)
+GRAYSCALE_MATRIX: ColourMatrix = (0.299, 0.587, 0.114, 0)  # The same weights that Pillow uses when converting to "L"
+
+
+def posterize_lut(bits: int) -> LUT:
+    """ Create a lookup table that keeps only the highest bits of each value """
+    mask = ~(2 ** (8 - bits) - 1) & 0xff
+    return [value & mask for value in range(256)]
+
+
+def gradient_lut(start: int, end: int) -> LUT:
+    """ Create a lookup table that maps 0-255 onto a linear gradient between start and end """
+    return [start + value * (end - start) // 255 for value in range(256)]
+
+
+def compose_luts(*luts: LUT) -> LUT:
+    """ Combine several lookup tables into one that applies them in order """
+    result = IDENTITY_LUT
+    for lut in luts:
+        result = [lut[value] for value in result]
+    return result
+
+
+def apply_lut(image: Image.Image, lut: LUT | tuple[LUT, LUT, LUT]) -> Image.Image:
+    """ Apply a lookup table to the colour channels of the image
+
+     Takes either a single LUT for all colour channels, or a separate LUT for each of the red, green, and blue channels """
+    per_channel = isinstance(lut, tuple)
+    if image.mode not in ("L", "LA", "RGB", "RGBA") or (per_channel and image.mode in ("L", "LA")):
+        image = image.convert("RGBA")
+    colour_luts = list(lut) if per_channel else [lut] * (len(image.getbands()) - ("A" in image.getbands()))
+    if "A" in image.getbands():
+        colour_luts.append(IDENTITY_LUT)
+    return image.point([value for channel in colour_luts for value in channel])
+
+
+def apply_matrix(image: Image.Image, matrix: ColourMatrix) -> Image.Image:
+    """ Apply a colour matrix to the image
+
+     A 12-value matrix produces a colour image, while a 4-value matrix produces a grayscale image """
+    alpha = image.getchannel("A") if "A" in image.getbands() else None
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    output = image.convert("L" if len(matrix) == 4 else "RGB", matrix=matrix)
+    if alpha is not None:
+        output.putalpha(alpha)
+    return output
+
+
+def channel_mean(image: Image.Image) -> float:
+    """ Calculate the mean value of a single-channel image """
+    histogram = image.histogram()
+    return sum(value * count for value, count in enumerate(histogram)) / max(sum(histogram), 1)
+
+
+class ColourOperation:
+    """ A colour operation that is either a lookup table or a colour matrix
+
+     Operations of the same kind can be merged into one, so a chain of them still only goes over the image once """
+
+    def __init__(self, lut: LUT | tuple[LUT, LUT, LUT] | None = None, matrix: ColourMatrix | None = None):
+        self.lut = lut
+        self.matrix = matrix
+
+    def __call__(self, image: Image.Image) -> Image.Image:
+        if self.lut is not None:
+            return apply_lut(image, self.lut)
+        return apply_matrix(image, self.matrix)
+
+    def merge(self, other: "ColourOperation") -> "ColourOperation | None":
+        """ Combine this operation with the one applied after it, or return None if they can't be combined """
+        if self.lut is not None and other.lut is not None:
+            if isinstance(self.lut, tuple) or isinstance(other.lut, tuple):
+                first = self.lut if isinstance(self.lut, tuple) else (self.lut,) * 3
+                second = other.lut if isinstance(other.lut, tuple) else (other.lut,) * 3
+                return ColourOperation(lut=tuple(compose_luts(a, b) for a, b in zip(first, second)))
+            return ColourOperation(lut=compose_luts(self.lut, other.lut))
+        if self.matrix is not None and other.matrix is not None:
+            # Note that the merged matrix does not clip the values in between the two operations
+            first = self._rows(self.matrix)
+            second = self._rows(other.matrix)
+            rows = [
+                [sum(row[k] * first[k][column] for k in range(3)) + (row[3] if column == 3 else 0) for column in range(4)]
+                for row in second
+            ]
+            return ColourOperation(matrix=tuple(value for row in rows[:len(other.matrix) // 4] for value in row))
+        return None
+
+    @staticmethod
+    def _rows(matrix: ColourMatrix) -> list[list[float]]:
+        """ Split the matrix into red, green, and blue rows - a grayscale matrix gives the same value to all three """
+        rows = [list(matrix[i:i + 4]) for i in range(0, len(matrix), 4)]
+        return rows * 3 if len(rows) == 1 else rows
+
+
 # These functions are used by the Images cog
-def _resize_image(image: Image.Image) -> Image.Image:
-    """ Resize the image to have no more than 512x512 pixels and return the new image"""
-    image = image.convert("RGBA")
-    width, height = image.size
+# The single-frame filters (_blur, _deepfry, etc.) expect an image that has already been through _prepare
+def _fit_size(size: tuple[int, int]) -> tuple[int, int]:
+    """ Get the size that the image has to be shrunk to, so that it has no more than 512x512 pixels """
+    width, height = size
     pixels = width * height
     if pixels > MAX_SIZE:
         fraction: float = (pixels / MAX_SIZE) ** 0.5
-        width: int = int(width / fraction)
-        height: int = int(height / fraction)
-        image = image.resize((width, height))
+        return int(width / fraction), int(height / fraction)
+    return size
+
+
+def admit(image: Image.Image, max_frame_bytes: int = MAX_FRAME_BYTES, max_decoded_pixels: int = MAX_DECODED_PIXELS) -> int:
+    """ Decide how much of an image can be decoded, using only what its header says - no pixels are decoded here
+
+     Large JPEG images are set up to be decoded straight at a lower resolution, so they are estimated at that resolution.
+     Raises ImageRejected if a single decoded frame would take up more than max_frame_bytes.
+     Returns how many frames can be decoded without going over max_decoded_pixels in total. """
+    size = _fit_size(image.size)
+    if size != image.size:
+        image.draft(None, size)  # Only JPEG images support this, it does nothing for other formats
+    width, height = image.size
+    pixels = max(width * height, 1)
+    n_frames = getattr(image, "n_frames", 1)
+    # Frames are decoded as RGBA at most, and animated images also keep the previous frame around to draw the next one on top of it
+    frame_bytes = pixels * 4 * (2 if n_frames > 1 else 1)
+    if frame_bytes > max_frame_bytes:
+        raise ImageRejected(f"The image is too large to be processed ({width}x{height})")
+    return max(1, min(n_frames, max_decoded_pixels // pixels))
+
+
+def _prepare(image: Image.Image) -> Image.Image:
+    """ Prepare an image (or a frame) for the filters: shrink it to no more than 512x512 pixels and convert it to RGBA
+
+     The filters expect an already prepared image, so this is done exactly once before the filter runs. """
+    size = _fit_size(image.size)
+    if size != image.size:
+        # JPEG images can be decoded straight at a lower resolution, instead of decoding the full image and shrinking it afterwards
+        image.draft(None, size)
+        if image.mode not in ("L", "LA", "RGB", "RGBA"):
+            image = image.convert("RGBA")  # Palette images can't be resized smoothly
+        # The reducing gap makes Pillow first shrink the image with Image.reduce, which is a lot faster for large images
+        image = image.resize(size, reducing_gap=3.0)
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
     return image
 
 
-def _wrap_animated[**P](image: Image.Image, function: Callable[Concatenate[Image.Image, P], Image.Image], *fn_args: P, max_frames: int = MAX_FRAMES) -> Image.Image | list[Image.Image]:
+def _wrap_animated[**P](image: Image.Image, function: Callable[Concatenate[Image.Image, P], Image.Image], *fn_args: P, max_frames: int = MAX_FRAMES,
+                       threads: int = 0) -> Image.Image | list[Image.Image]:
     """ Generic wrapper around the if-statement regarding animated and still images """
     if max_frames > 1 and getattr(image, "is_animated", False):  # Magik is too resource-intensive to support gifs
-        return _handle_animated(image, function, *fn_args, max_frames=max_frames)
+        return _handle_animated(image, function, *fn_args, max_frames=max_frames, threads=threads)
     else:
-        return function(image, *fn_args)
+        return function(_prepare(image), *fn_args)
 
 
-def _handle_animated[**P](image: Image.Image, function: Callable[Concatenate[Image.Image, P], Image.Image], *fn_args: P, max_frames: int = MAX_FRAMES) -> list[Image.Image]:
+def _handle_animated[**P](image: Image.Image, function: Callable[Concatenate[Image.Image, P], Image.Image], *fn_args: P, max_frames: int = MAX_FRAMES,
+                          threads: int = 0) -> list[Image.Image]:
     """ Handle animated images
 
      Function signature: function(image, *everything_else) -> new_image """
-    frames = []
+    return list(_iter_animated(image, function, *fn_args, max_frames=max_frames, threads=threads))
+
+
+def _iter_animated[**P](image: Image.Image, function: Callable[Concatenate[Image.Image, P], Image.Image], *fn_args: P, max_frames: int = MAX_FRAMES,
+                       decode_frames: int = 0, threads: int = 0) -> Generator[Image.Image, None, None]:
+    """ Apply the function to the frames of an animated image, yielding each new frame (in order) as soon as it's ready
+
+     Frames skipped to stay within max_frames are still decoded (later frames may be drawn on top of them), but never filtered.
+     If decode_frames is set, only that many frames from the start of the image are decoded at all.
+     With more than one thread, the frames are still decoded one after another, but filtered in parallel in chunks of FRAME_CHUNK_SIZE. """
     loop = image.info.get("loop", 1)
+    frames = _select_frames(image, max_frames, decode_frames)
+    if threads > 1:
+        new_frames = _filter_in_threads(frames, lambda frame: function(frame, *fn_args), threads)
+    else:
+        new_frames = ((function(frame, *fn_args), duration) for frame, duration in frames)
+    for new_frame, duration in new_frames:
+        new_frame.info["duration"] = duration
+        new_frame.info["loop"] = loop
+        yield new_frame
+
+
+def _select_frames(image: Image.Image, max_frames: int, decode_frames: int) -> Generator[tuple[Image.Image, float], None, None]:
+    """ Decode the frames of an animated image, yielding the frames that will be kept (prepared for the filters) along with their durations """
     n_frames = getattr(image, "n_frames", 1)
+    if decode_frames:
+        n_frames = min(n_frames, decode_frames)
     idx = saved_frames = 0
     fraction = (n_frames / max_frames) if n_frames > max_frames else 1
-    for frame in Iterator(image):
+    for frame in itertools.islice(Iterator(image), n_frames):
         idx += 1
         if n_frames > max_frames and (idx / n_frames * max_frames) < saved_frames:
             continue  # If there are over 100 frames, skip some to only have up to 100 in the output
         saved_frames += 1
-        new_frame = function(frame, *fn_args)
-        new_frame.info["duration"] = frame.info["duration"] * fraction  # Extend the duration of each frame by the ratio of skipped frames
-        new_frame.info["loop"] = loop
-        frames.append(new_frame)
-    return frames
+        prepared = _prepare(frame)
+        if prepared is frame:
+            prepared = frame.copy()  # The image object itself is reused for the next frame, which may be decoded while this one is still being filtered
+        yield prepared, frame.info["duration"] * fraction  # Extend the duration of each frame by the ratio of skipped frames
+
+
+def _filter_in_threads(frames: Iterable[tuple[Image.Image, float]], function: Callable[[Image.Image], Image.Image],
+                       threads: int) -> Generator[tuple[Image.Image, float], None, None]:
+    """ Filter the frames in parallel, yielding them in their original order
+
+     Pillow releases the GIL while it processes pixels, so threads can use several cores without having to pickle any frames.
+     Only a couple of chunks per thread are in flight at once, so the frames still stream through instead of all being held in memory. """
+    def filter_chunk(chunk: tuple[tuple[Image.Image, float], ...]) -> list[tuple[Image.Image, float]]:
+        return [(function(frame), duration) for frame, duration in chunk]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for chunk in itertools.batched(frames, FRAME_CHUNK_SIZE):
+            pending.append(executor.submit(filter_chunk, chunk))
+            if len(pending) >= threads * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
 
 
 def _rgb_operation(image: Image.Image, function: Callable[[Image.Image], Image.Image]) -> Image.Image:
     """ Wrapper around functions that only support RGB operations """
-    image = _resize_image(image)
     r, g, b, a = image.split()
     rgb_image = Image.merge("RGB", (r, g, b))
     rgb_image = function(rgb_image)
@@ -139,25 +601,26 @@ def _rgb_operation(image: Image.Image, function: Callable[[Image.Image], Image.I
 
 def _blur(image: Image.Image) -> Image.Image:
     """ Blur the image """
-    image = _resize_image(image)
     return image.filter(ImageFilter.GaussianBlur(radius=2.5))
 
 
 def _deepfry(image: Image.Image) -> Image.Image:
     """ Deep-fry the image """
     # https://github.com/KagChi/alex_api_archive/blob/master/render/filter.py#L62-L77
-    image = _resize_image(image)
     image = image.convert("RGB")
     width, height = image.size
     image = image.resize((int(width ** 0.75), int(height ** 0.75)), resample=Resampling.LANCZOS)
     image = image.resize((int(width ** 0.88), int(height ** 0.88)), resample=Resampling.BILINEAR)
     image = image.resize((int(width ** 0.90), int(height ** 0.90)), resample=Resampling.BICUBIC)
     image = image.resize((width, height), resample=Resampling.BICUBIC)
-    image = ImageOps.posterize(image, 4)  # Reduce the 8-bit channels to just 4 bits
-    red = image.split()[0]
-    red = ImageEnhance.Contrast(red).enhance(2.0)
-    red = ImageEnhance.Brightness(red).enhance(1.5)
-    red = ImageOps.colorize(red, (254, 0, 2), (255, 255, 15))
+    image = apply_lut(image, posterize_lut(4))  # Reduce the 8-bit channels to just 4 bits
+    red = image.getchannel("R")
+    # Boost the red channel's contrast (around its mean) and brightness, and then colour it from red to yellow - all in a single pass
+    mean = channel_mean(red)
+    contrast = [min(max(round(mean + (value - mean) * 2.0), 0), 255) for value in range(256)]
+    brightness = [min(round(value * 1.5), 255) for value in range(256)]
+    red_luts = tuple(compose_luts(contrast, brightness, gradient_lut(start, end)) for start, end in zip((254, 0, 2), (255, 255, 15)))
+    red = apply_lut(red.convert("RGB"), red_luts)
     image = Image.blend(image, red, 0.75)
     image = ImageEnhance.Sharpness(image).enhance(100.0)
     return image
@@ -165,31 +628,27 @@ def _deepfry(image: Image.Image) -> Image.Image:
 
 def _flip(image: Image.Image) -> Image.Image:
     """ Flip the image vertically """
-    image = _resize_image(image)
     return ImageOps.flip(image)
 
 
 def _mirror(image: Image.Image) -> Image.Image:
     """ Flip the image horizontally """
-    image = _resize_image(image)
     return ImageOps.mirror(image)
 
 
 def _grayscale(image: Image.Image) -> Image.Image:
     """ Make the image black and white """
-    image = _resize_image(image)
-    return image.convert("LA")
+    return apply_matrix(image, GRAYSCALE_MATRIX)
 
 
 def _invert(image: Image.Image) -> Image.Image:
     """ Invert the colours of the image """
-    return _rgb_operation(image, ImageOps.invert)
+    return apply_lut(image, INVERT_LUT)
 
 
 def _jpegify(image: Image.Image) -> Image.Image:
     """ Apply the beauties of JPEG to the image """
     # https://github.com/KagChi/alex_api_archive/blob/master/render/filter.py#L41-L43
-    image = _resize_image(image)
     image = image.convert("RGB")  # JPEG doesn't support the alpha channel
     bio = BytesIO()
     image.save(bio, format="JPEG", quality=10)  # 10 is very low
@@ -200,7 +659,6 @@ def _jpegify(image: Image.Image) -> Image.Image:
 def _pixelate(image: Image.Image) -> Image.Image:
     """ Pixelate the image """
     # https://github.com/KagChi/alex_api_archive/blob/master/render/filter.py#L27-L40
-    image = _resize_image(image)
     original_size = image.size
     image = ImageEnhance.Color(image).enhance(1.25)     # Boost image saturation
     image = ImageEnhance.Contrast(image).enhance(1.25)  # Boost image contrast
@@ -214,36 +672,22 @@ def _pixelate(image: Image.Image) -> Image.Image:
 
 def _rank(image: Image.Image) -> Image.Image:
     """ Apply a rank filter to the image """
-    image = _resize_image(image)
     return _rgb_operation(image, lambda img: img.filter(ImageFilter.RankFilter(size=5, rank=0)))
 
 
 def _sepia(image: Image.Image) -> Image.Image:
     """ Apply a sepia filter over the image """
-    image = _resize_image(image)
-    pixels = image.getdata()
-    output_pixels = []
-    for r, g, b, alpha in pixels:
-        # https://stackoverflow.com/a/9449159
-        new_r = min(int(0.393 * r + 0.769 * g + 0.189 * b), 255)
-        new_g = min(int(0.349 * r + 0.686 * g + 0.168 * b), 255)
-        new_b = min(int(0.272 * r + 0.534 * g + 0.131 * b), 255)
-        output_pixels.append((new_r, new_g, new_b, alpha))
-    new_image = Image.new("RGBA", image.size)
-    new_image.putdata(output_pixels)
-    return new_image
+    return apply_matrix(image, SEPIA_MATRIX)
 
 
 def _spread(image: Image.Image) -> Image.Image:
     """ Randomly spread pixels of the image """
-    image = _resize_image(image)
     return image.effect_spread(distance=16)
 
 
 def _wide(image: Image.Image) -> Image.Image:
     """ Make the image wider """
     # https://github.com/KagChi/alex_api_archive/blob/master/render/filter.py#L78-L82
-    image = _resize_image(image)
     width, height = image.size
     return image.resize((int(width * 1.25), int(height / 1.5)))
 
@@ -306,3 +750,122 @@ def spread(image: Image.Image) -> Image.Image | list[Image.Image]:
 def wide(image: Image.Image) -> Image.Image | list[Image.Image]:
     """ Make the image wider """
     return _wrap_animated(image, _wide)
+
+
+FILTERS: dict[str, Callable[[Image.Image], Image.Image]] = {
+    "blur": _blur,
+    "deepfry": _deepfry,
+    "flip": _flip,
+    "grayscale": _grayscale,
+    "invert": _invert,
+    "jpegify": _jpegify,
+    "mirror": _mirror,
+    "pixelate": _pixelate,
+    "rank": _rank,
+    "sepia": _sepia,
+    "spread": _spread,
+    "wide": _wide,
+}
+""" The function that applies each filter to a single frame """
+COLOUR_OPERATIONS: dict[str, ColourOperation] = {
+    "grayscale": ColourOperation(matrix=GRAYSCALE_MATRIX),
+    "invert": ColourOperation(lut=INVERT_LUT),
+    "sepia": ColourOperation(matrix=SEPIA_MATRIX),
+}
+""" Filters that are plain colour operations, which can be merged with their neighbours in a filter chain """
+RGBA_FILTERS: set[str] = {"pixelate", "rank"}
+""" Filters that only work on RGBA images - the others also accept L, LA and RGB images """
+NON_DETERMINISTIC: set[str] = {"spread"}
+""" Filters that give a different output every time they are run """
+
+
+def parse_chain(chain: str) -> list[str]:
+    """ Parse a chain of filters, such as "blur+invert+wide", into a list of filter names
+
+     "random" is replaced with a randomly chosen filter """
+    filter_names = []
+    for filter_name in chain.lower().split("+"):
+        filter_name = filter_name.strip()
+        if filter_name == "random":
+            filter_name = random.choice(list(FILTERS))
+        if filter_name not in FILTERS:
+            raise InvalidFilter(f"Unknown filter: {filter_name}", filter_name)
+        filter_names.append(filter_name)
+    if len(filter_names) > MAX_CHAIN_LENGTH:
+        raise InvalidFilter(f"A chain can have at most {MAX_CHAIN_LENGTH} filters", chain)
+    return filter_names
+
+
+class FilterPlan:
+    """ A chain of filters, fused into as few steps as possible
+
+     Neighbouring colour operations are merged together. The plan is applied to a single frame that _prepare() has already resized
+     and converted to RGBA, so the image is still only resized and encoded once. A colour operation may return another mode
+     (e.g. LA for grayscale), so the image is converted back to RGBA before a later filter that needs it. """
+
+    def __init__(self, filter_names: list[str]):
+        self.filter_names = filter_names
+        self.steps: list[tuple[Callable[[Image.Image], Image.Image], bool]] = []  # (function, needs RGBA)
+        for filter_name in filter_names:
+            operation = COLOUR_OPERATIONS.get(filter_name)
+            if operation is not None and self.steps and isinstance(self.steps[-1][0], ColourOperation):
+                merged = self.steps[-1][0].merge(operation)
+                if merged is not None:
+                    self.steps[-1] = (merged, False)
+                    continue
+            if operation is not None:
+                self.steps.append((operation, False))
+            else:
+                self.steps.append((FILTERS[filter_name], filter_name in RGBA_FILTERS))
+
+    def __call__(self, image: Image.Image) -> Image.Image:
+        for function, needs_rgba in self.steps:
+            if image.mode != "RGBA" and (needs_rgba or image.mode not in ("L", "LA", "RGB")):
+                image = image.convert("RGBA")
+            image = function(image)
+        return image
+
+
+def apply_chain(image: Image.Image, filter_names: list[str], threads: int = 0) -> Image.Image | list[Image.Image]:
+    """ Apply a chain of filters to the image, filtering the frames of animated images in up to the given number of threads """
+    return _wrap_animated(image, FilterPlan(filter_names), threads=threads)
+
+
+def render(data: bytes, filter_names: list[str], streaming: bool = True, animated_format: str = "gif", effort: int = DEFAULT_EFFORT,
+           quality: int = DEFAULT_QUALITY, max_frame_bytes: int = MAX_FRAME_BYTES, max_decoded_pixels: int = MAX_DECODED_PIXELS,
+           threads: int = 0) -> tuple[bytes, str, int]:
+    """ Decode the image, apply the chain of filters, and encode the output
+
+     This runs as a single job inside a worker process, so it only takes and returns plain data.
+     The image goes through admit() first, so images that are too large are rejected (or cut short) before any of their pixels are decoded.
+     With streaming enabled, animated images are filtered and encoded one frame at a time instead of collecting every frame first.
+     With more than one thread, the frames of animated images are filtered in parallel.
+     Returns the encoded image, its file extension, and the peak memory used by the job in bytes. """
+    memory = PeakMemory()
+    try:
+        image = load_from_bytes(data)
+    except Image.DecompressionBombError:  # Pillow's own, much higher limit
+        raise ImageRejected("The image is too large to be processed") from None
+    decode_frames = admit(image, max_frame_bytes, max_decoded_pixels)
+    plan = FilterPlan(filter_names)
+    if getattr(image, "is_animated", False):
+        frames = _sample_memory(_iter_animated(image, plan, decode_frames=decode_frames, threads=threads), memory)
+        if streaming:
+            bio = stream_to_bio(frames, animated_format, effort, quality)
+        else:
+            bio = save_to_bio(list(frames), animated_format, effort, quality)
+        file_format = ANIMATED_FORMATS[animated_format]
+    else:
+        image = _prepare(image)
+        memory.sample()
+        bio = save_to_bio(plan(image))
+        file_format = "png"
+    memory.sample()
+    return bio.read(), file_format, memory.used
+
+
+def _sample_memory(frames: Iterable[Image.Image], memory: PeakMemory) -> Generator[Image.Image, None, None]:
+    """ Sample the memory usage after each frame is produced """
+    for frame in frames:
+        memory.sample()
+        yield frame
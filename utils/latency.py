@@ -0,0 +1,112 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+import aiohttp
+import discord
+from discord.http import Route
+
+from utils import logs
+
+
+class LatencySample:
+    """ The heartbeat latency and REST round trip measured at one point in time (None if it couldn't be measured) """
+    __slots__ = ("time", "heartbeat", "rest")
+
+    def __init__(self, when: float, heartbeat: float | None, rest: float | None):
+        self.time = when  # time.time() of when the sample was taken
+        self.heartbeat = heartbeat
+        self.rest = rest
+
+
+class LatencySampler:
+    """ Measures the gateway heartbeat latency and a REST round trip every interval seconds in the background
+
+     The samples are kept in a ring buffer that covers the last history seconds, so that a one-off spike can be told apart from a slow hour. """
+
+    def __init__(self, bot: discord.Client, logger: logs.Logger, interval: float, history: float):
+        self.bot = bot
+        self.logger = logger
+        self.interval = interval
+        self.history = history
+        self.samples: deque[LatencySample] = deque(maxlen=math.ceil(history / interval))
+        self.task: asyncio.Task | None = None
+
+    @classmethod
+    def from_config(cls, bot: discord.Client, logger: logs.Logger, config: dict) -> "LatencySampler":
+        """ Create a latency sampler from its section of the config """
+        return cls(bot, logger, interval=config["interval"], history=config["history"])
+
+    def start(self):
+        """ Start taking samples in the background """
+        if self.task is None:
+            self.task = asyncio.create_task(self._sampler())
+
+    async def close(self):
+        """ Stop taking samples """
+        if self.task is not None:
+            self.task.cancel()  # There is nothing to save, and the bot might not even be ready yet
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _sampler(self):
+        """ Take a sample every interval seconds, once the bot is connected """
+        await self.bot.wait_until_ready()
+        while True:
+            self.samples.append(await self.sample())
+            await asyncio.sleep(self.interval)
+
+    async def sample(self) -> LatencySample:
+        """ Measure the latencies right now """
+        heartbeat = self.bot.latency
+        if not math.isfinite(heartbeat):  # Not connected at the moment
+            heartbeat = None
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.bot.http.request(Route("GET", "/users/@me")), timeout=self.interval)
+            rest = time.perf_counter() - start
+        except (discord.HTTPException, aiohttp.ClientError, TimeoutError) as e:
+            self.logger.error("latency_error", f"Failed to measure the REST latency: {type(e).__name__}: {e}")
+            rest = None
+        return LatencySample(time.time(), heartbeat, rest)
+
+    def recent(self) -> list[LatencySample]:
+        """ Get the samples from the last history seconds """
+        cutoff = time.time() - self.history
+        return [sample for sample in self.samples if sample.time >= cutoff]
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """ Get the p50, p95, p99 and maximum of the heartbeat and REST latencies over the last history seconds """
+        samples = self.recent()
+        output = {}
+        for kind in ("heartbeat", "rest"):
+            values = sorted(value for sample in samples if (value := getattr(sample, kind)) is not None)
+            output[kind] = {"samples": len(values), "failed": len(samples) - len(values), "p50": percentile(values, 0.5),
+                            "p95": percentile(values, 0.95), "p99": percentile(values, 0.99), "max": values[-1] if values else math.nan}
+        return output
+
+    def spikes(self, count: int = 5) -> list[LatencySample]:
+        """ Get the samples with the worst latencies over the last history seconds, the worst first """
+        def worst(sample: LatencySample) -> float:
+            if sample.rest is None:
+                return math.inf  # A failed request is worse than any slow one
+            return max(sample.rest, sample.heartbeat or 0)
+        return sorted(self.recent(), key=worst, reverse=True)[:count]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """ Get a percentile (nearest rank) of a sorted list, or NaN if it's empty """
+    if not values:
+        return math.nan
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def milliseconds(seconds: float | None) -> str:
+    """ Show a latency in milliseconds """
+    if seconds is None or math.isnan(seconds):
+        return "unknown"
+    return f"{seconds * 1000:,.0f}ms"
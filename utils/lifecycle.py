@@ -0,0 +1,89 @@
+import asyncio
+
+from discord.ext import commands
+
+from utils import logs
+
+
+class ShuttingDown(commands.CheckFailure):
+    """ Exception raised when a command is used while the bot is shutting down, or while its extension is being reloaded """
+    pass
+
+
+class Lifecycle:
+    """ Lets the bot shut down and reload extensions without cutting off the commands that are still running
+
+     Every command is tracked from its before-invoke hook until its after-invoke hook (or its error handler).
+     While draining, new commands are rejected, and the running ones get up to drain_timeout seconds to finish. """
+
+    def __init__(self, bot: commands.Bot, logger: logs.Logger, drain_timeout: float):
+        self.bot = bot
+        self.logger = logger
+        self.drain_timeout = drain_timeout
+        self.running: set[commands.Context] = set()
+        self.finished = asyncio.Event()  # Set whenever a command finishes
+        self.draining = False
+        self.reloading: set[str] = set()  # Extensions whose commands are not accepted right now
+        self.task: asyncio.Task | None = None
+
+    @classmethod
+    def from_config(cls, bot: commands.Bot, logger: logs.Logger, config: dict) -> "Lifecycle":
+        """ Create a lifecycle manager from its section of the config """
+        return cls(bot, logger, drain_timeout=config["drain_timeout"])
+
+    def check(self, ctx: commands.Context) -> bool:
+        """ Global check that rejects new commands while the bot is shutting down, or while the command's extension is reloading """
+        if self.draining:
+            raise ShuttingDown("The bot is restarting, please try again in a minute.")
+        if ctx.command.module in self.reloading:
+            raise ShuttingDown("This command is being updated, please try again in a few seconds.")
+        return True
+
+    async def command_started(self, ctx: commands.Context):
+        self.running.add(ctx)
+
+    async def command_finished(self, ctx: commands.Context):
+        self.running.discard(ctx)
+        self.finished.set()
+
+    async def wait_idle(self, extension: str | None = None, exclude: commands.Context | None = None) -> int:
+        """ Wait until the commands (of the extension, if given) have finished, or until drain_timeout seconds have passed
+
+         exclude is the command that is waiting, as it can't finish before this does. Returns how many commands are still running. """
+        deadline = asyncio.get_running_loop().time() + self.drain_timeout
+        while True:
+            busy = [ctx for ctx in self.running if ctx is not exclude and (extension is None or ctx.command.module == extension)]
+            remaining = deadline - asyncio.get_running_loop().time()
+            if not busy or remaining <= 0:
+                return len(busy)
+            self.finished.clear()
+            try:
+                await asyncio.wait_for(self.finished.wait(), timeout=remaining)
+            except TimeoutError:
+                pass
+
+    async def reload_extension(self, name: str, exclude: commands.Context | None = None) -> int:
+        """ Reload an extension once its running commands have finished, returning how many were still running at the deadline """
+        self.reloading.add(name)
+        try:
+            still_running = await self.wait_idle(name, exclude)
+            await self.bot.reload_extension(name)
+        finally:
+            self.reloading.discard(name)
+        return still_running
+
+    async def shutdown(self, exclude: commands.Context | None = None):
+        """ Stop accepting commands, wait for the running ones to finish, and close the bot (which flushes the logs, caches, and error reports) """
+        if self.draining:
+            return
+        self.draining = True
+        self.logger.info("drain", f"Waiting for {len(self.running - {exclude})} running commands to finish...")
+        still_running = await self.wait_idle(exclude=exclude)
+        if still_running:
+            self.logger.error("drain_timeout", f"{still_running} commands were still running after {self.drain_timeout}s", count=still_running)
+        await self.bot.close()
+
+    def request_shutdown(self):
+        """ Shut down in the background, e.g. when the process is asked to stop """
+        if self.task is None:
+            self.task = asyncio.create_task(self.shutdown())
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+import sys
+from collections import deque
+
+from utils import general
+
+
+class Logger:
+    """ Logs the bot's events without ever making the event loop wait for the terminal or the disk
+
+     Entries are put in an in-memory queue, and a background task writes them in batches from a separate thread:
+     to the console in the usual "time > bot > message" format (with the shard for entries that have a shard_id),
+     and as JSON lines to a file that is rotated once it reaches max_bytes.
+     If the writer can't keep up and the queue fills up, new entries are dropped (and counted) instead of blocking. """
+
+    def __init__(self, name: str, console: bool = True, path: str = "", max_bytes: int = 0, backups: int = 0, flush_interval: float = 1, max_queue: int = 10000):
+        self.name = name
+        self.console = console
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queue: deque[dict] = deque()
+        self.dropped = 0
+        self.file = None
+        self.file_size = 0
+        self.wake = asyncio.Event()
+        self.stopping = False
+        self.task: asyncio.Task | None = None
+
+    @classmethod
+    def from_config(cls, name: str, config: dict) -> "Logger":
+        """ Create a logger from its section of the config """
+        return cls(name, console=config["console"], path=config["path"], max_bytes=config["max_bytes"], backups=config["backups"],
+                   flush_interval=config["flush_interval"], max_queue=config["max_queue"])
+
+    def info(self, event: str, message: str, **fields):
+        """ Log an event - the extra fields are only included in the JSON lines """
+        self._add("info", event, message, fields)
+
+    def error(self, event: str, message: str, **fields):
+        """ Log an error - it is shown on standard error in the console """
+        self._add("error", event, message, fields)
+
+    def _add(self, level: str, event: str, message: str, fields: dict):
+        """ Queue an entry to be written """
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append({"time": general.iso_time(), "level": level, "event": event, "message": message, **fields})
+        if len(self.queue) >= 100:
+            self.wake.set()  # Don't let large bursts wait for the next flush
+
+    def start(self):
+        """ Start the background writer - entries logged before this are kept until it starts """
+        if self.task is None:
+            self.task = asyncio.create_task(self._writer())
+
+    async def close(self):
+        """ Write everything that is still queued, and stop the writer """
+        self.stopping = True
+        self.wake.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        else:
+            await self._flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _take_batch(self) -> list[dict]:
+        """ Take every queued entry out of the queue """
+        batch = list(self.queue)
+        self.queue.clear()
+        if self.dropped:
+            batch.append({"time": general.iso_time(), "level": "error", "event": "log_dropped", "message": f"Dropped {self.dropped} log entries", "count": self.dropped})
+            self.dropped = 0
+        return batch
+
+    async def _writer(self):
+        """ Write the queued entries every flush_interval seconds, or sooner if a lot of them pile up """
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self.wake.clear()
+            await self._flush()
+        await self._flush()  # Entries logged while the last batch was being written
+
+    async def _flush(self):
+        """ Write the queued entries in a separate thread """
+        if not self.queue and not self.dropped:
+            return
+        try:
+            await asyncio.to_thread(self._write, self._take_batch())
+        except OSError as e:  # Keep the writer going even if the disk is full or the file went missing
+            general.print_stderr(f"{general.iso_time()} > {self.name} > Failed to write logs: {type(e).__name__}: {e}")
+            if self.file is not None:
+                self.file.close()
+                self.file = None  # Try to open the file again next time
+
+    def _write(self, batch: list[dict]):
+        """ Write a batch of entries to the console and the log file - this runs in a separate thread """
+        if self.console:
+            output = [f"{entry["time"]} > {self._prefix(entry)} > {entry["message"]}\n" for entry in batch if entry["level"] != "error"]
+            errors = [f"{entry["time"]} > {self._prefix(entry)} > {entry["message"]}\n" for entry in batch if entry["level"] == "error"]
+            if output:
+                sys.stdout.write("".join(output))
+                sys.stdout.flush()
+            if errors:
+                sys.stderr.write("".join(errors))
+                sys.stderr.flush()
+        if self.path:
+            data = "".join(json.dumps(entry, ensure_ascii=False, default=str) + "\n" for entry in batch).encode("utf-8")
+            if self.file is None:
+                self._open_file()
+            elif self.max_bytes and self.file_size and self.file_size + len(data) > self.max_bytes:
+                self._rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.file_size += len(data)
+
+    def _prefix(self, entry: dict) -> str:
+        """ Show which shard an entry came from, if it came from one """
+        if entry.get("shard_id") is None:
+            return self.name
+        return f"{self.name} [shard {entry["shard_id"]}]"
+
+    def _open_file(self):
+        """ Open the log file for appending """
+        if directory := os.path.dirname(self.path):
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "ab")
+        self.file_size = self.file.tell()
+
+    def _rotate(self):
+        """ Rename bot.jsonl to bot.jsonl.1, bot.jsonl.1 to bot.jsonl.2, and so on, keeping up to the configured number of backups """
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open_file()
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+from utils import stats
+
+
+class MemberLookup:
+    """ Finds members and users that might not be in discord.py's cache
+
+     When the member cache is restricted, members and users are looked up through the API instead,
+     and the results (including "not a member") are kept for ttl seconds, up to max_entries of them.
+     Guilds whose members haven't been counted yet are chunked on demand (without caching the members) to count them. """
+
+    def __init__(self, bot: discord.Client, guild_stats: stats.GuildStats, ttl: float, max_entries: int):
+        self.bot = bot
+        self.guild_stats = guild_stats
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[int, int], tuple[float, discord.Member | discord.User | None]] = OrderedDict()  # (guild ID or 0, user ID) -> (expiry, result)
+        self.locks: dict[int, asyncio.Lock] = {}  # guild ID -> lock held while the guild is being chunked
+
+    @classmethod
+    def from_config(cls, bot: discord.Client, guild_stats: stats.GuildStats, config: dict) -> "MemberLookup":
+        """ Create a member lookup from the member_cache section of the config """
+        return cls(bot, guild_stats, ttl=config["lookup_ttl"], max_entries=config["max_lookups"])
+
+    async def get_member(self, guild: discord.Guild, user_id: int) -> discord.Member | None:
+        """ Get a member of the guild, or None if the user isn't in it """
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        return await self._lookup((guild.id, user_id), guild.fetch_member, user_id)
+
+    async def get_user(self, user_id: int) -> discord.User | None:
+        """ Get a user, or None if they don't exist """
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            return user
+        return await self._lookup((0, user_id), self.bot.fetch_user, user_id)
+
+    async def guild_counts(self, guild: discord.Guild) -> stats.GuildCounts:
+        """ Get the guild's member counts, chunking the guild to count them if they haven't been counted yet """
+        counts = self.guild_stats.get(guild.id)
+        if counts is not None:
+            return counts
+        if guild.chunked:
+            self.guild_stats.recount(guild)
+            return self.guild_stats.get(guild.id)
+        lock = self.locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:  # Don't chunk the same guild twice at once
+            counts = self.guild_stats.get(guild.id)
+            if counts is None:
+                self.guild_stats.count(guild.id, await guild.chunk(cache=False))
+                counts = self.guild_stats.get(guild.id)
+        if not lock.locked():
+            self.locks.pop(guild.id, None)
+        return counts
+
+    async def _lookup(self, key: tuple[int, int], fetch, user_id: int):
+        """ Return the cached result for the key if it hasn't expired, or fetch it """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            return entry[1]
+        try:
+            result = await fetch(user_id)
+        except discord.NotFound:
+            result = None
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return result
+
+
+def member_cache_flags(config: dict) -> discord.MemberCacheFlags:
+    """ Get the member cache flags from the member_cache section of the config """
+    return discord.MemberCacheFlags(joined=config["cache_joined"], voice=False)  # The bot doesn't have the voice states intent
@@ -0,0 +1,172 @@
+import math
+import time
+
+from aiohttp import web
+from discord.ext import commands
+
+
+BUCKETS: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+""" The upper bounds of the histogram buckets, in seconds """
+
+
+class TimedContext(commands.Context):
+    """ Command context that remembers when the command was invoked, and times how long each defer and send takes """
+
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        self.started: float = time.perf_counter()
+        self.timings: list[tuple[str, float]] = []  # (phase, seconds) for every defer and send
+
+    async def send(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().send(*args, **kwargs)
+        finally:
+            self.timings.append(("send", time.perf_counter() - start))
+
+    async def defer(self, *, ephemeral: bool = False):
+        start = time.perf_counter()
+        try:
+            return await super().defer(ephemeral=ephemeral)
+        finally:
+            self.timings.append(("defer", time.perf_counter() - start))
+
+    def typing(self, *, ephemeral: bool = False):
+        # For slash commands, typing() defers the interaction without going through defer()
+        return _TimedTyping(self, super().typing(ephemeral=ephemeral))
+
+
+class _TimedTyping:
+    """ Wrapper around ctx.typing() that times how long it takes to start typing (or to defer the interaction) """
+
+    def __init__(self, ctx: TimedContext, typing):
+        self.ctx = ctx
+        self.typing = typing
+
+    def __await__(self):
+        return self._timed(self.typing).__await__()
+
+    async def __aenter__(self):
+        return await self._timed(self.typing.__aenter__())
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await self.typing.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def _timed(self, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.ctx.timings.append(("defer", time.perf_counter() - start))
+
+
+class Histogram:
+    """ Counts how many observations fall into each of the BUCKETS """
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def quantile(self, quantile: float) -> float:
+        """ Estimate a quantile as the upper bound of the bucket it falls into """
+        target = quantile * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return math.inf
+
+
+class CommandMetrics:
+    """ Per-command histograms of how long commands take in total, and how long their defers and sends take """
+
+    def __init__(self, port: int = 0):
+        self.port = port
+        self.histograms: dict[tuple[str, str], Histogram] = {}  # (command, phase) -> histogram
+        self.errors: dict[str, int] = {}
+        self.runner: web.AppRunner | None = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "CommandMetrics":
+        """ Create the metrics from their section of the config """
+        return cls(port=config["port"])
+
+    def record(self, ctx: commands.Context, failed: bool = False):
+        """ Record a command that has just completed (or failed) """
+        if ctx.command is None or not isinstance(ctx, TimedContext):
+            return
+        command = ctx.command.qualified_name
+        self._observe(command, "total", time.perf_counter() - ctx.started)
+        for phase, seconds in ctx.timings:
+            self._observe(command, phase, seconds)
+        if failed:
+            self.errors[command] = self.errors.get(command, 0) + 1
+
+    def _observe(self, command: str, phase: str, seconds: float):
+        histogram = self.histograms.get((command, phase))
+        if histogram is None:
+            histogram = self.histograms[(command, phase)] = Histogram()
+        histogram.observe(seconds)
+
+    def summary(self) -> list[tuple[str, int, int, float, float, float, float]]:
+        """ Get (command, calls, errors, mean, p50, p95, p95 of sends) for every command, the slowest first """
+        rows = []
+        for (command, phase), histogram in self.histograms.items():
+            if phase != "total":
+                continue
+            send = self.histograms.get((command, "send"))
+            rows.append((command, histogram.count, self.errors.get(command, 0), histogram.total / histogram.count,
+                         histogram.quantile(0.5), histogram.quantile(0.95), send.quantile(0.95) if send else 0))
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def prometheus(self) -> str:
+        """ Format the metrics in the Prometheus text format """
+        lines = ["# HELP bot_command_duration_seconds How long commands, and the defers and sends within them, take",
+                 "# TYPE bot_command_duration_seconds histogram"]
+        for (command, phase), histogram in sorted(self.histograms.items()):
+            labels = f'command="{_escape(command)}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'bot_command_duration_seconds_bucket{{{labels},le="{"+Inf" if bound == math.inf else bound}"}} {cumulative}')
+            lines.append(f"bot_command_duration_seconds_sum{{{labels}}} {histogram.total}")
+            lines.append(f"bot_command_duration_seconds_count{{{labels}}} {histogram.count}")
+        lines.extend(["# HELP bot_command_errors_total How many times each command failed", "# TYPE bot_command_errors_total counter"])
+        for command, count in sorted(self.errors.items()):
+            lines.append(f'bot_command_errors_total{{command="{_escape(command)}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    async def start(self):
+        """ Serve the metrics on localhost, if a port is set """
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def close(self):
+        """ Stop serving the metrics """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.prometheus().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+def _escape(value: str) -> str:
+    """ Escape a Prometheus label value """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
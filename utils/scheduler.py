@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from collections.abc import Callable, Generator
+from typing import Hashable
+
+
+class QueueFull(Exception):
+    """ Exception raised when a job can't be queued, either because the queue is full or because its user or server already has too many jobs """
+    def __init__(self, text: str, queued: int):
+        super().__init__(text)
+        self.queued = queued
+        """ How many jobs were waiting in the queue at the time """
+
+
+class Ticket:
+    """ A job's place in the scheduler - wait() for the job's turn, and release it from the scheduler once the job is done """
+
+    def __init__(self, scheduler: "JobScheduler", user_id: int, group: Hashable):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.group = group
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()  # Resolved once the job is allowed to start
+        self.queued_at: float = time.perf_counter()
+
+    @property
+    def position(self) -> int:
+        """ How many queued jobs will start before this one (plus one), or 0 if the job is already allowed to start """
+        return self.scheduler.position(self)
+
+    async def wait(self):
+        """ Wait until the job is allowed to start """
+        await self.future
+
+
+class JobScheduler:
+    """ A bounded queue in front of the heavy jobs, which runs at most a set number of them at once
+
+     Waiting jobs are started in a round-robin over servers, and over the users within each server,
+     so a single busy server (or a single user spamming commands) can't make everyone else wait behind them.
+     Jobs from DMs are grouped per user. """
+
+    def __init__(self, concurrency: int, max_queued: int, max_per_user: int, max_per_guild: int):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.max_per_guild = max_per_guild
+        self.running: set[Ticket] = set()
+        self.queue: OrderedDict[Hashable, OrderedDict[int, deque[Ticket]]] = OrderedDict()  # group -> user -> waiting tickets
+        self.queued = 0
+        self.wait_times: deque[float] = deque(maxlen=100)  # How long the most recent jobs had to wait before starting
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "JobScheduler":
+        """ Create a job scheduler from its section of the config """
+        return cls(concurrency=config["concurrency"], max_queued=config["max_queued"], max_per_user=config["max_per_user"], max_per_guild=config["max_per_guild"])
+
+    def submit(self, user_id: int, guild_id: int | None) -> Ticket:
+        """ Add a job to the queue (or start it straight away if there's room), raising QueueFull if there's no space for it
+
+         The ticket must always be released afterwards, even if the job never got to run. """
+        group = guild_id if guild_id is not None else ("dm", user_id)
+        if self.queued >= self.max_queued:
+            self._reject(f"The bot is too busy at the moment - {self.queued} jobs are already waiting. Please try again later.")
+        if self._count(lambda ticket: ticket.user_id == user_id) >= self.max_per_user:
+            self._reject(f"You already have {self.max_per_user} jobs running or waiting. Please wait for them to finish first.")
+        if self._count(lambda ticket: ticket.group == group) >= self.max_per_guild:
+            self._reject(f"This server already has {self.max_per_guild} jobs running or waiting. Please try again later.")
+        ticket = Ticket(self, user_id, group)
+        self.queue.setdefault(group, OrderedDict()).setdefault(user_id, deque()).append(ticket)
+        self.queued += 1
+        self._dispatch()
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """ Remove a job from the scheduler, whether it is running or still waiting - releasing it twice does nothing """
+        if ticket in self.running:
+            self.running.remove(ticket)
+        elif self._remove(ticket):
+            self.queued -= 1
+        self._dispatch()
+
+    def position(self, ticket: Ticket) -> int:
+        """ Find where the ticket is in the order that the waiting jobs will be started in """
+        if ticket.future.done():
+            return 0
+        for position, queued in enumerate(self._order(), start=1):
+            if queued is ticket:
+                return position
+        return 0
+
+    def stats(self) -> dict[str, int | float]:
+        """ Get the current queue depth and the recent wait times (in seconds) """
+        wait_times = sorted(self.wait_times)
+        return {
+            "running": len(self.running),
+            "queued": self.queued,
+            "waiting_servers": len(self.queue),
+            "rejected": self.rejected,
+            "median_wait": wait_times[len(wait_times) // 2] if wait_times else 0,
+            "max_wait": wait_times[-1] if wait_times else 0,
+            "oldest_waiting": max((time.perf_counter() - ticket.queued_at for ticket in self._order()), default=0),
+        }
+
+    def _reject(self, text: str):
+        """ Count and raise a rejection """
+        self.rejected += 1
+        raise QueueFull(text, self.queued)
+
+    def _count(self, predicate: Callable[[Ticket], bool]) -> int:
+        """ Count the running and waiting jobs that match the predicate """
+        return sum(1 for ticket in self.running if predicate(ticket)) + sum(1 for ticket in self._order() if predicate(ticket))
+
+    def _order(self) -> Generator[Ticket, None, None]:
+        """ Yield the waiting tickets in the order that they will be started in, without changing the queue """
+        groups = [[deque(tickets) for tickets in users.values()] for users in self.queue.values()]
+        while groups:
+            for users in list(groups):
+                tickets = users.pop(0)
+                yield tickets.popleft()
+                if tickets:
+                    users.append(tickets)
+                if not users:
+                    groups.remove(users)
+
+    def _remove(self, ticket: Ticket) -> bool:
+        """ Take a waiting ticket out of the queue, returning whether it was there at all """
+        users = self.queue.get(ticket.group)
+        if users is None or ticket not in users.get(ticket.user_id, ()):
+            return False
+        tickets = users[ticket.user_id]
+        tickets.remove(ticket)
+        if not tickets:
+            del users[ticket.user_id]
+        if not users:
+            del self.queue[ticket.group]
+        return True
+
+    def _dispatch(self):
+        """ Start waiting jobs while there are free slots, taking turns between servers and between users """
+        while self.queue and len(self.running) < self.concurrency:
+            group, users = next(iter(self.queue.items()))
+            user_id, tickets = next(iter(users.items()))
+            ticket = tickets.popleft()
+            self.queued -= 1
+            # Move the user and the server to the back of the line, so that the others get the next turns
+            if tickets:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                self.queue.move_to_end(group)
+            else:
+                del self.queue[group]
+            if ticket.future.cancelled():
+                continue
+            self.running.add(ticket)
+            self.wait_times.append(time.perf_counter() - ticket.queued_at)
+            ticket.future.set_result(None)
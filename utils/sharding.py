@@ -0,0 +1,85 @@
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+
+class GatewayError(RuntimeError):
+    """ Exception raised when Discord can't tell how many shards the bot should use """
+    pass
+
+
+def shard_options(config: dict, token: str) -> dict:
+    """ Get the shard_count and shard_ids to create the bot with from the sharding section of the config (None lets discord.py decide)
+
+     discord.py needs the shard count when only some of the shards are run, so if it isn't set, it's asked from Discord here. """
+    shard_count, shard_ids = config["shard_count"] or None, config["shard_ids"] or None
+    if shard_ids is not None:
+        if shard_count is None:
+            shard_count = fetch_gateway(token)["shards"]
+        if invalid := [shard_id for shard_id in shard_ids if not 0 <= shard_id < shard_count]:
+            raise ValueError(f"The shard IDs {", ".join(map(str, invalid))} are not valid with {shard_count} shards (they go from 0 to {shard_count - 1})")
+    return {"shard_count": shard_count, "shard_ids": shard_ids}
+
+
+def split_shards(shard_ids: list[int], clusters: int) -> list[list[int]]:
+    """ Split the shards into (at most) the given number of groups of consecutive shards, as evenly as possible """
+    clusters = max(min(clusters, len(shard_ids)), 1)
+    size, extra = divmod(len(shard_ids), clusters)
+    groups, start = [], 0
+    for index in range(clusters):
+        end = start + size + (1 if index < extra else 0)
+        groups.append(shard_ids[start:end])
+        start = end
+    return groups
+
+
+def format_shards(shard_ids: list[int]) -> str:
+    """ Show a group of shards as "0-3", or "5" for a single shard """
+    if len(shard_ids) == 1:
+        return str(shard_ids[0])
+    return f"{shard_ids[0]}-{shard_ids[-1]}" if shard_ids == list(range(shard_ids[0], shard_ids[-1] + 1)) else ",".join(map(str, shard_ids))
+
+
+def cluster_path(path: str, cluster: int) -> str:
+    """ Give each cluster its own copy of a file or directory, e.g. logs/bot.jsonl -> logs/bot.cluster1.jsonl, cache/renders -> cache/renders.cluster1 """
+    if not path:
+        return path
+    root, extension = os.path.splitext(path.rstrip("/\\"))
+    return f"{root}.cluster{cluster}{extension}"
+
+
+def apply_cluster(config: dict, cluster: int, shard_ids: list[int], shard_count: int):
+    """ Set up the config for one cluster process
+
+     Files that can't be shared between processes get a separate copy for each cluster, and the metrics are served on a separate port.
+     This covers the log file, the disk cache (its index and size limit are only tracked in memory), the snipe database,
+     and the startup report (which would otherwise get the lines of several clusters mixed together). """
+    config["sharding"].update(shard_ids=shard_ids, shard_count=shard_count, cluster=cluster)
+    config["logging"]["path"] = cluster_path(config["logging"]["path"], cluster)
+    config["render_cache"]["disk_path"] = cluster_path(config["render_cache"]["disk_path"], cluster)
+    config["snipe"]["database"] = cluster_path(config["snipe"]["database"], cluster)
+    config["startup"]["report_path"] = cluster_path(config["startup"]["report_path"], cluster)
+    if config["metrics"]["port"]:
+        config["metrics"]["port"] += cluster
+
+
+def fetch_gateway(token: str, attempts: int = 3) -> dict:
+    """ Ask Discord how many shards the bot should use, and how many shards can be started at once (session_start_limit)
+
+     If the request is rate limited, it is tried again after as long as Discord asks (up to attempts times in total). """
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot"})
+    for attempt in range(1, attempts + 1):
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 401:
+                raise GatewayError("Discord rejected the bot's token - check the token in config.json") from None
+            if e.code == 429 and attempt < attempts:
+                time.sleep(float(e.headers.get("Retry-After") or 5))
+                continue
+            raise GatewayError(f"Discord returned HTTP {e.code} ({e.reason}) when asked for the shard count") from None
+        except (OSError, json.JSONDecodeError) as e:  # Including urllib's URLError, e.g. when Discord can't be reached
+            raise GatewayError(f"Could not ask Discord for the shard count: {type(e).__name__}: {e}") from None
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from datetime import UTC, datetime
+
+import discord
+
+from utils import logs
+
+
+class SnipedMessage:
+    """ The parts of a deleted message that the snipe command shows """
+    __slots__ = ("content", "author_id", "author_name", "avatar_url", "created_at", "forwarded", "deleted_at")
+
+    def __init__(self, content: str, author_id: int, author_name: str, avatar_url: str, created_at: datetime, forwarded: bool, deleted_at: float):
+        self.content = content
+        self.author_id = author_id
+        self.author_name = author_name
+        self.avatar_url = avatar_url
+        self.created_at = created_at
+        self.forwarded = forwarded
+        self.deleted_at = deleted_at  # time.time() of when the message was deleted
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "SnipedMessage":
+        """ Copy the necessary fields out of the message, so that the message object itself doesn't have to be kept """
+        if message.message_snapshots:
+            content, forwarded = message.message_snapshots[0].content, True
+        else:
+            content, forwarded = message.system_content, False
+        author = message.author
+        return cls(content, author.id, author.global_name or author.name, author.display_avatar.url, message.created_at, forwarded, time.time())
+
+
+class SnipeStore:
+    """ Keeps the last few deleted messages of each channel
+
+     Every channel has a ring buffer of up to per_channel messages, and messages are forgotten after ttl seconds.
+     Once more than max_messages are stored in total, the oldest messages of the least recently active channels are dropped first. """
+
+    def __init__(self, per_channel: int, ttl: float, max_messages: int):
+        self.per_channel = per_channel
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.channels: OrderedDict[int, deque[SnipedMessage]] = OrderedDict()  # channel ID -> messages (newest last), least recently active channel first
+        self.size = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "SnipeStore":
+        """ Create a snipe store from its section of the config """
+        return cls(per_channel=config["per_channel"], ttl=config["ttl"], max_messages=config["max_messages"])
+
+    def add(self, channel_id: int, message: SnipedMessage):
+        """ Store a deleted message """
+        messages = self.channels.get(channel_id)
+        if messages is None:
+            messages = self.channels[channel_id] = deque()
+        else:
+            self.channels.move_to_end(channel_id)
+        if len(messages) >= self.per_channel:
+            messages.popleft()
+            self.size -= 1
+        messages.append(message)
+        self.size += 1
+        # Expire the least recently active channel a bit at a time, so that channels nobody snipes in don't stay around forever
+        self._expire(next(iter(self.channels)))
+        while self.size > self.max_messages:
+            oldest_channel_id, oldest = next(iter(self.channels.items()))
+            oldest.popleft()
+            self.size -= 1
+            if not oldest:
+                del self.channels[oldest_channel_id]
+
+    def get(self, channel_id: int, number: int = 1) -> SnipedMessage | None:
+        """ Get the channel's nth most recently deleted message (starting from 1), or None if there isn't one """
+        if channel_id not in self.channels:
+            return None
+        messages = self._expire(channel_id)
+        if not 1 <= number <= len(messages):
+            return None
+        return messages[-number]
+
+    def count(self, channel_id: int) -> int:
+        """ Count how many deleted messages the channel has stored """
+        return len(self._expire(channel_id)) if channel_id in self.channels else 0
+
+    def _expire(self, channel_id: int) -> deque[SnipedMessage]:
+        """ Drop the channel's messages that are older than the TTL, and return the ones that are left """
+        messages = self.channels[channel_id]
+        cutoff = time.time() - self.ttl
+        while messages and messages[0].deleted_at < cutoff:
+            messages.popleft()
+            self.size -= 1
+        if not messages:
+            del self.channels[channel_id]
+        return messages
+
+
+class SnipeDatabase:
+    """ Stores deleted messages in a SQLite file, so that they survive restarts and cog reloads
+
+     Messages are queued in memory and written in batches every flush_interval seconds by a background task,
+     so on_message_delete never waits for the disk. The same task deletes messages older than the TTL every prune_interval seconds.
+     Only that task (and open/close, before and after it runs) touches the connection. """
+
+    def __init__(self, path: str, ttl: float, per_channel: int, flush_interval: float, prune_interval: float, logger: logs.Logger):
+        self.path = path
+        self.ttl = ttl
+        self.per_channel = per_channel
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+        self.logger = logger
+        self.connection: sqlite3.Connection | None = None
+        self.queue: list[tuple] = []
+        self.stopping = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    @classmethod
+    def from_config(cls, config: dict, logger: logs.Logger) -> "SnipeDatabase":
+        """ Create a snipe database from the snipe section of the config """
+        return cls(path=config["database"], ttl=config["ttl"], per_channel=config["per_channel"],
+                   flush_interval=config["flush_interval"], prune_interval=config["prune_interval"], logger=logger)
+
+    async def open(self) -> list[tuple[int, SnipedMessage]]:
+        """ Open the database and start the background writer, returning the stored messages (oldest first) to fill the in-memory store with """
+        rows = await asyncio.to_thread(self._open)
+        self.task = asyncio.create_task(self._writer())
+        return [(row[0], SnipedMessage(row[1], row[2], row[3], row[4], datetime.fromtimestamp(row[5], UTC), bool(row[6]), row[7])) for row in rows]
+
+    def write(self, channel_id: int, message: SnipedMessage):
+        """ Queue a deleted message to be written to the database """
+        self.queue.append((channel_id, message.content, message.author_id, message.author_name, message.avatar_url,
+                           message.created_at.timestamp(), message.forwarded, message.deleted_at))
+
+    async def close(self):
+        """ Write the messages that are still queued, and close the database """
+        if self.task is None:
+            return
+        self.stopping.set()
+        await self.task
+        self.task = None
+        await asyncio.to_thread(self.connection.close)
+
+    async def _writer(self):
+        """ Write the queued messages every flush_interval seconds, and prune old ones every prune_interval seconds """
+        last_prune = time.monotonic()
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            prune = time.monotonic() - last_prune >= self.prune_interval
+            if prune:
+                last_prune = time.monotonic()
+            await self._flush(prune)
+        await self._flush(False)  # Messages queued while the last batch was being written, or before the first flush if closed right away
+
+    async def _flush(self, prune: bool):
+        """ Write the queued messages (and prune old ones if asked to) in a separate thread """
+        rows, self.queue = self.queue, []
+        if not rows and not prune:
+            return
+        try:
+            await asyncio.to_thread(self._write, rows, prune)
+        except sqlite3.Error as e:  # Losing a batch of snipes is better than stopping the writer altogether
+            self.logger.error("snipe_error", f"Failed to write {len(rows)} snipes to {self.path}: {type(e).__name__}: {e}")
+
+    def _open(self) -> list[tuple]:
+        """ Connect to the database, create the table if needed, and read the messages that haven't expired yet """
+        if directory := os.path.dirname(self.path):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)  # Used from asyncio.to_thread, but never from two threads at once
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snipes (channel_id INTEGER, content TEXT, author_id INTEGER, author_name TEXT, "
+                                "avatar_url TEXT, created_at REAL, forwarded INTEGER, deleted_at REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS snipes_deleted_at ON snipes (deleted_at)")
+        return self.connection.execute("SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY deleted_at DESC) AS position "
+                                       "FROM snipes WHERE deleted_at >= ?) WHERE position <= ? ORDER BY deleted_at",
+                                       (time.time() - self.ttl, self.per_channel)).fetchall()
+
+    def _write(self, rows: list[tuple], prune: bool):
+        """ Insert a batch of messages in a single transaction, and if it's time to, delete the expired ones
+         and the ones beyond the newest per_channel of each channel (which would never be shown again) """
+        with self.connection:
+            self.connection.executemany("INSERT INTO snipes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if prune:
+                self.connection.execute("DELETE FROM snipes WHERE deleted_at < ?", (time.time() - self.ttl,))
+                self.connection.execute("DELETE FROM snipes WHERE rowid IN (SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER "
+                                        "(PARTITION BY channel_id ORDER BY deleted_at DESC) AS position FROM snipes) WHERE position > ?)",
+                                        (self.per_channel,))
@@ -0,0 +1,103 @@
+import ast
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import discord
+from discord.ext import commands
+
+from utils import general, logs
+
+
+class ExtensionTiming:
+    """ How long an extension took to import and to set up """
+    __slots__ = ("name", "import_time", "setup_time")
+
+    def __init__(self, name: str, import_time: float, setup_time: float):
+        self.name = name
+        self.import_time = import_time
+        self.setup_time = setup_time
+
+
+class StartupReport:
+    """ Times the bot's startup: loading each extension, and how long it takes until the bot is ready
+
+     Once the bot is ready, the report is logged and appended as a JSON line to the file at path,
+     so that the startup times of different versions can be compared. """
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.started = time.perf_counter()
+        self.extensions: list[ExtensionTiming] = []
+        self.loaded_time: float | None = None  # When all extensions were loaded, relative to the start
+        self.ready_time: float | None = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "StartupReport":
+        """ Create a startup report from its section of the config """
+        return cls(path=config["report_path"])
+
+    async def load_extensions(self, bot: commands.Bot, names: list[str]):
+        """ Load the extensions one at a time, in the given order
+
+         The modules that each extension imports are imported before discord.py loads it, so that the time spent on its dependencies
+         is measured separately from the time it takes to run the extension's own code and its setup function.
+         The extension itself is only run once, by discord.py. """
+        for name in names:
+            start = time.perf_counter()
+            import_dependencies(name)
+            imported = time.perf_counter()
+            await bot.load_extension(name)
+            self.extensions.append(ExtensionTiming(name, imported - start, time.perf_counter() - imported))
+        self.loaded_time = time.perf_counter() - self.started
+
+    def ready(self, logger: logs.Logger, memory_usage: tuple[int, bool] | None, **fields):
+        """ Record that the bot is ready, then log and store the report
+
+         memory_usage is what general.memory_usage() returned - where only the peak is known, it's reported as such. """
+        self.ready_time = time.perf_counter() - self.started
+        memory, memory_peak = memory_usage or (None, False)
+        if memory is None:
+            memory_text = "unknown"
+        else:
+            memory_text = f"{"at most " if memory_peak else ""}{memory / 2 ** 20:,.1f} MiB"
+        extensions = ", ".join(f"{timing.name} {timing.import_time * 1000:,.0f}+{timing.setup_time * 1000:,.0f}ms" for timing in self.extensions)
+        logger.info("startup", f"Ready in {self.ready_time:.2f}s using {memory_text} of memory - extensions loaded in {self.loaded_time or 0:.2f}s "
+                               f"(import+setup: {extensions})", ready_seconds=round(self.ready_time, 3), memory_bytes=memory, memory_peak=memory_peak, **fields)
+        if self.path:
+            report = {"time": general.iso_time(), "python": sys.version.split()[0], "discord.py": discord.__version__,
+                      "ready_seconds": round(self.ready_time, 3), "extensions_seconds": round(self.loaded_time or 0, 3), "memory_bytes": memory, "memory_peak": memory_peak,
+                      "extensions": {timing.name: {"import": round(timing.import_time, 4), "setup": round(timing.setup_time, 4)} for timing in self.extensions},
+                      **fields}
+            try:
+                if directory := os.path.dirname(self.path):
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(report) + "\n")
+            except OSError as e:
+                logger.error("startup_error", f"Failed to save the startup report to {self.path}: {type(e).__name__}: {e}")
+
+
+def import_dependencies(name: str):
+    """ Import the modules that the module imports at its top level, without running the module itself
+
+     Imports inside functions are left alone, as they are meant to only happen once they're needed. """
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        return  # discord.py will report that the extension doesn't exist
+    for node in ast.parse(spec.loader.get_source(name)).body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                importlib.import_module(alias.name)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            importlib.import_module(node.module)
+            for alias in node.names:
+                submodule = f"{node.module}.{alias.name}"
+                try:  # "from utils import general" imports a submodule, while "from time import time" doesn't
+                    importlib.import_module(submodule)
+                except ModuleNotFoundError as e:
+                    if e.name != submodule:
+                        raise
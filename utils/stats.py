@@ -0,0 +1,67 @@
+import discord
+
+
+class GuildCounts:
+    """ How many humans and bots are in a guild """
+    __slots__ = ("humans", "bots")
+
+    def __init__(self, humans: int = 0, bots: int = 0):
+        self.humans = humans
+        self.bots = bots
+
+
+class GuildStats:
+    """ Member counts for every guild, kept up to date by the guild and member events
+
+     A guild's members are only counted in full when it becomes available (or gets chunked), after that joins and leaves adjust the counts,
+     so the commands that show them never have to go through the member list. """
+
+    def __init__(self):
+        self.guilds: dict[int, GuildCounts] = {}
+        self.humans = 0
+        self.bots = 0
+
+    def get(self, guild_id: int) -> GuildCounts | None:
+        """ Get the counts for a guild, or None if it hasn't been counted yet """
+        return self.guilds.get(guild_id)
+
+    def recount(self, guild: discord.Guild):
+        """ Count the guild's cached members from scratch
+
+         If not all of its members are cached, the guild is forgotten instead, to be counted on demand later. """
+        if guild.chunked:
+            self.count(guild.id, guild.members)
+        else:
+            self.remove_guild(guild.id)
+
+    def count(self, guild_id: int, members: list[discord.Member]):
+        """ Set the guild's counts from a full list of its members """
+        bots = sum(1 for member in members if member.bot)
+        self.remove_guild(guild_id)
+        counts = self.guilds[guild_id] = GuildCounts(len(members) - bots, bots)
+        self.humans += counts.humans
+        self.bots += counts.bots
+
+    def remove_guild(self, guild_id: int):
+        """ Forget a guild that the bot has left """
+        counts = self.guilds.pop(guild_id, None)
+        if counts is not None:
+            self.humans -= counts.humans
+            self.bots -= counts.bots
+
+    def member_join(self, member: discord.Member):
+        self._adjust(member.guild.id, member.bot, 1)
+
+    def member_remove(self, guild_id: int, user: discord.User | discord.Member):
+        self._adjust(guild_id, user.bot, -1)
+
+    def _adjust(self, guild_id: int, bot: bool, change: int):
+        counts = self.guilds.get(guild_id)
+        if counts is None:
+            return  # The guild will be counted in full once it becomes available (or when someone asks for its counts)
+        if bot:
+            counts.bots += change
+            self.bots += change
+        else:
+            counts.humans += change
+            self.humans += change
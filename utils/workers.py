@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+
+
+class JobTimeout(TimeoutError):
+    """ Exception raised when a job runs for longer than the pool's timeout """
+    def __init__(self, text: str, timeout: float):
+        super().__init__(text)
+        self.timeout = timeout
+        """ The timeout (in seconds) that the job exceeded """
+
+
+class WorkerCrashed(RuntimeError):
+    """ Exception raised when a worker process died while running the job, e.g. because it ran out of memory """
+    pass
+
+
+class ProcessPool:
+    """ A pool of worker processes that runs CPU-heavy jobs away from the event loop """
+
+    def __init__(self, workers: int, max_jobs_per_worker: int = 0, timeout: float = 0):
+        self.workers = workers
+        self.max_jobs_per_worker = max_jobs_per_worker or None  # Recycle a worker after this many jobs to free up its memory
+        self.timeout = timeout or None
+        self.generation = 0  # Incremented every time the pool is restarted
+        self.executor = self._make_executor()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ProcessPool":
+        """ Create a process pool from its section of the config """
+        return cls(workers=config["workers"], max_jobs_per_worker=config["max_jobs_per_worker"], timeout=config["timeout"])
+
+    def _make_executor(self) -> ProcessPoolExecutor:
+        """ Create a new executor - the worker processes themselves are only spawned once jobs are submitted
+
+         The workers are always started with spawn rather than fork (Python only picks spawn by itself when max_tasks_per_child is set):
+         forking the bot would copy its event loop, the locks held by its threads, and its open sockets into every worker. """
+        return ProcessPoolExecutor(max_workers=self.workers, max_tasks_per_child=self.max_jobs_per_worker, mp_context=multiprocessing.get_context("spawn"))
+
+    async def run[**P, T](self, function: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        """ Run the function in a worker process and wait for its result
+
+         The function and its arguments must be picklable, so only pass module-level functions and plain data """
+        job = functools.partial(function, *args, **kwargs)
+        generation = self.generation
+        try:
+            return await self._submit(job)
+        except BrokenProcessPool:
+            if generation != self.generation:
+                # Another job restarted the pool (it timed out, or its worker died), so this job itself was fine - try it again once
+                return await self._submit(job)
+            # One of the workers of this pool died, and the job may well have been what killed it (e.g. by running out of memory),
+            # so it isn't tried again, as that could break everyone else's jobs a second time
+            self.restart()
+            raise WorkerCrashed("A worker process died while running the job") from None
+
+    async def _submit[T](self, job: Callable[[], T]) -> T:
+        """ Submit the job to the current executor, killing it if the job times out """
+        future = self.executor.submit(job)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except TimeoutError:
+            # Cancelling the future does not stop a job that is already running, so the worker has to be killed
+            self.restart()
+            raise JobTimeout(f"The job took longer than {self.timeout} seconds", self.timeout) from None
+        except asyncio.CancelledError:
+            if future.cancelled() and not asyncio.current_task().cancelling():
+                # The job was still queued when the pool was restarted, rather than the caller being cancelled
+                raise BrokenProcessPool("The pool was restarted before the job could run") from None
+            raise
+
+    def restart(self):
+        """ Kill all worker processes and replace them with a fresh pool
+
+         This stops every job that is running or queued on the old pool, not just the one that timed out or crashed -
+         those jobs get a BrokenProcessPool error, and run() tries them again on the new pool.
+         Killing the workers needs the executor's private list of processes, as there is no public way to stop a running job. """
+        executor = self.executor
+        self.executor = self._make_executor()
+        self.generation += 1
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        """ Stop the worker processes """
+        self.executor.shutdown(wait=False, cancel_futures=True)